@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+End-to-end search benchmarks against a local fake ESGF server
+
+    python benchmark/bench_search.py --datasets 200 --files 50 --latency 0.05
+
+Reports throughput in files/s and peak Python memory for each stage (from
+a second run, as tracing memory slows everything down)
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest import esgf, throttle
+from esgfrequest.cli import search_esgf
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.model import Base, Checksum, Basename
+from esgfrequest.match import chunks
+
+benchmarks = []
+
+def benchmark(f):
+    benchmarks.append(f)
+    return f
+
+@contextmanager
+def quiet():
+    """
+    Hide the search progress dots and messages
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+
+def local_db(server, path, fraction=0.5):
+    """
+    Create a SQLite checksum database holding `fraction` of the files on
+    `server`, returning a session connected to it
+    """
+    engine = create_engine('sqlite:///%s'%path)
+    Base.metadata.create_all(engine)
+    keep = server.files[:int(len(server.files) * fraction)]
+    with engine.begin() as conn:
+        for batch in chunks(enumerate(keep), 10000):
+            conn.execute(Checksum.__table__.insert(),
+                    [{'ch_hash': str(i), 'ch_md5': None, 'ch_sha256': f['checksum'][0]} for i, f in batch])
+            conn.execute(Basename.__table__.insert(),
+                    [{'pa_hash': str(i), 'basename': f['title']} for i, f in batch])
+    return sessionmaker(bind=engine)()
+
+@benchmark
+def files_generator(server, session):
+    return sum(1 for _ in esgf.search_files_generator(search_url=server.search_url,
+        fields=['title', 'checksum', 'size'], limit=1000))
+
+@benchmark
+def dataset_files_generator(server, session):
+    return sum(1 for _ in esgf.search_dataset_files_generator(search_url=server.search_url,
+        fields=['dataset_id', 'variable', 'title', 'checksum', 'size']))
+
+@benchmark
+def full_search(server, session):
+    results, count = search_esgf({'search_url': server.search_url}, len(server.files), session)
+    return count
+
+@benchmark
+def full_search_processes(server, session):
+    results, count = search_esgf({'search_url': server.search_url}, len(server.files), session,
+            processes=4)
+    return count
+
+def run(f, server, session):
+    """
+    Time `f`, then run it again to measure its peak memory, as tracing
+    allocations also slows down the fake server running in this process
+
+    Returns the count, seconds, peak memory and number of requests of the
+    timed run
+    """
+    requests = server.requests
+    start = time.time()
+    with quiet():
+        count = f(server, session)
+    elapsed = time.time() - start
+    requests = server.requests - requests
+
+    tracemalloc.start()
+    with quiet():
+        f(server, session)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, elapsed, peak, requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', type=int, default=100)
+    parser.add_argument('--files', type=int, default=100,
+            help="Files per dataset")
+    parser.add_argument('--latency', type=float, default=0.01,
+            help="Server latency per request in seconds")
+    parser.add_argument('--max_limit', type=int, default=10000,
+            help="Server maximum page size")
+    args = parser.parse_args()
+
+    with FakeESGF(datasets=args.datasets, files=args.files,
+            latency=args.latency, max_limit=args.max_limit) as server:
+        # Measure the code rather than the rate limit
+        throttle.configure(server.search_url, rate=1e9, burst=1e9)
+        tmpdir = tempfile.mkdtemp()
+        session = local_db(server, os.path.join(tmpdir, 'mas.db'))
+
+        print("%-25s %8s %8s %10s %10s %10s"%(
+            'benchmark', 'files', 'requests', 'seconds', 'files/s', 'peak MB'))
+        for f in benchmarks:
+            count, elapsed, peak, requests = run(f, server, session)
+            print("%-25s %8d %8d %10.2f %10.0f %10.1f"%(
+                f.__name__, count, requests, elapsed, count / elapsed, peak / 1e6))
+
+if __name__ == '__main__':
+    main()
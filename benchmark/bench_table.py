@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Result summary benchmarks
+
+    python benchmark/bench_table.py --rows 1000000
+
+Compares totalling a results dict with generator passes against the
+columnar ResultTable
+"""
+from __future__ import print_function
+import argparse
+import random
+import time
+from esgfrequest.table import ResultTable
+
+def make_results(rows):
+    rng = random.Random(0)
+    results = {}
+    for i in range(rows):
+        d = 'cmip5.output1.INST.MODEL.historical.mon.atmos.Amon.r%di1p1.v20120101|node'%i
+        results[d + ' tas'] = {
+                'dataset_id': d, 'variable': 'tas',
+                'matches': rng.randint(0, 10), 'partial': rng.randint(0, 2),
+                'misses': rng.randint(0, 3), 'size': rng.randint(0, 10**10),
+                }
+    return results
+
+def dict_summary(results):
+    return {
+        'total_misses': sum([v['misses'] for v in results.values()]),
+        'missing_size': sum([v['size'] if v['misses'] > 0 else 0 for v in results.values()]),
+        'total_partial': sum([v['partial'] for v in results.values()]),
+        'partial_size': sum([v['size'] if v['partial'] > 0 else 0 for v in results.values()]),
+        }
+
+def timed(name, f, *args):
+    start = time.time()
+    r = f(*args)
+    print("%-30s %8.3f s"%(name, time.time() - start))
+    return r
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    results = make_results(args.rows)
+
+    expected = timed('dict summary', dict_summary, results)
+    table = timed('ResultTable.from_results', ResultTable.from_results, results)
+    summary = timed('ResultTable.summary', table.summary)
+    timed('ResultTable.sort(size)', table.sort, 'size')
+    timed('ResultTable.take(misses > 0)', table.take, table.misses > 0)
+    assert summary == expected
+
+if __name__ == '__main__':
+    main()
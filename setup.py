@@ -9,13 +9,26 @@ setup(
         package_dir={'': 'src'},
         version=versioneer.get_version(),
         cmdclass=versioneer.get_cmdclass(),
+        python_requires='>=3.6',
 
         install_requires=[
             'sqlalchemy',
             'psycopg2',
+            'numpy',
             ],
+        extras_require={
+            'parquet': ['pyarrow'],
+            },
         entry_points={
             'console_scripts': [
                 'esgfrequest = esgfrequest.cli:cli',
+                'esgfrequest-mirror = esgfrequest.cli:mirror_cli',
+                'esgfrequest-batch = esgfrequest.batch:cli',
+                'esgfrequest-merge = esgfrequest.pending:merge_cli',
+                'esgfrequest-download = esgfrequest.download:cli',
+                'esgfrequest-verify = esgfrequest.verify:cli',
+                'esgfrequest-scan = esgfrequest.scan:cli',
+                'esgfrequest-serve = esgfrequest.server:cli',
+                'esgfrequest-coverage = esgfrequest.coverage:cli',
                 ]}
         )
@@ -1,7 +1,18 @@
-
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
-
+import sys
 from logging import getLogger
 logger = getLogger(__name__)
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # Resolving the version may run git, so only do it when asked for
+        if name == '__version__':
+            from ._version import get_versions
+            global __version__
+            __version__ = get_versions()['version']
+            return __version__
+        raise AttributeError("module %r has no attribute %r"%(__name__, name))
+else:
+    # Module __getattr__ (PEP 562) needs Python 3.7
+    from ._version import get_versions
+    __version__ = get_versions()['version']
+    del get_versions
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run many searches in one process
+
+Queries are read from a JSONL file, one JSON object of search facets per
+line, using the same names as the `esgfrequest` options:
+
+    {"name": "access-tas", "model": ["ACCESS1.0", "ACCESS1.3"], "variable": "tas"}
+    {"model": "^ACCESS1.0", "experiment": "rcp45", "latest": "all"}
+
+All queries share one HTTP session and one database connection, and the
+files of datasets that appear in several queries are only searched for and
+matched once.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import six
+from .cli import (text_facets, bool_facets, bool_or_all_arg,
+        handle_negative_facets, connect_db, search_esgf, render_request,
+        print_request_written)
+from . import logger
+
+def load_queries(path):
+    """
+    Read queries from the JSONL file `path`
+
+    Returns a list of (name, args) pairs, with args in the form used by
+    :func:`esgfrequest.cli.search_esgf`
+    """
+    queries = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+            query = json.loads(line)
+            name = query.pop('name', 'query%04d'%lineno)
+            queries.append((name, parse_query(query)))
+    return queries
+
+def parse_query(query):
+    """
+    Convert a JSON query into search arguments, the same as the command line
+    would produce
+    """
+    from .esgf import default_search_url
+
+    args = {'search_url': query.pop('search_url', default_search_url)}
+
+    for key, value in six.iteritems(query):
+        if key in text_facets:
+            if isinstance(value, six.string_types):
+                value = [value]
+            args[key] = [[v] for v in value]
+        elif key in bool_facets:
+            if isinstance(value, six.string_types):
+                value = bool_or_all_arg(value)
+            args[key] = value
+        else:
+            raise ValueError("Unknown search facet '%s'"%key)
+
+    for key, opts in six.iteritems(bool_facets):
+        args.setdefault(key, opts['default'])
+
+    return handle_negative_facets(args, text_facets)
+
+def run_batch(queries, cursor, limit=None, batch_size=250, memo=None):
+    """
+    Run a list of (name, args) queries through
+    :func:`esgfrequest.cli.search_esgf`
+
+    The queries share a :class:`esgfrequest.memo.SearchMemo`, so datasets
+    and files that appear in several queries are only searched for and
+    matched once
+
+    Returns a list of (name, results, count)
+    """
+    from . import esgf
+    from .memo import SearchMemo
+
+    if memo is None:
+        memo = SearchMemo()
+
+    out = []
+    for name, args in queries:
+        results, count = search_esgf(args, limit, cursor, batch_size, memo=memo)
+        out.append((name, results, count))
+
+    logger.info(memo.summary())
+    logger.info(esgf.single_flight.summary())
+    return out
+
+def write_results(path, name, results, count):
+    """
+    Write the results of one query as JSON
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'name': name,
+            'count': count,
+            'results': [results[k] for k in sorted(results)],
+            }, f, indent=1)
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries',
+            help="JSONL file of queries")
+    parser.add_argument('--outdir',
+            help="Directory to write results to, as NAME.json for each query",
+            default='.')
+    parser.add_argument('--request',
+            help="Write download request files for missing data",
+            action='store_true')
+    parser.add_argument('--user',
+            help="Username to connect to the database",
+            default=os.environ['USER'])
+    parser.add_argument('--db',
+            help="Match against a local SQLite mirror (from esgfrequest-mirror) instead of MAS")
+    parser.add_argument('--no_dataset_index',
+            help="Don't use or update the stored file lists of versioned datasets",
+            action='store_true')
+    parser.add_argument('--limit',
+            help="Maximum number of files to search for each query",
+            type=int)
+    parser.add_argument('--rate',
+            help="Most search requests per second to each index node",
+            type=float,
+            default=20)
+    args = parser.parse_args()
+
+    import sqlalchemy
+    from . import throttle
+    throttle.set_rate(args.rate)
+
+    queries = load_queries(args.queries)
+
+    try:
+        cursor = connect_db(user=args.user, db=args.db)
+    except (sqlalchemy.exc.OperationalError, IOError) as e:
+        print("\nError connecting to MAS database:")
+        print(e)
+        return -1
+
+    from .memo import SearchMemo, DatasetIndex, default_dataset_index_path
+    dataset_index = None
+    if not args.no_dataset_index:
+        dataset_index = DatasetIndex(default_dataset_index_path())
+    memo = SearchMemo(index=dataset_index)
+
+    index = None
+    if args.request:
+        from .pending import RequestIndex, default_index_path
+        index = RequestIndex(default_index_path())
+        index.prune()
+
+    out = run_batch(queries, cursor, args.limit, memo=memo)
+    for (name, query), (_, results, count) in zip(queries, out):
+        path = os.path.join(args.outdir, name + '.json')
+        write_results(path, name, results, count)
+        missing = sum(v['misses'] for v in six.itervalues(results))
+        print("%s: %d files, %d missing, written to %s"%(name, count, missing, path))
+
+        if args.request and missing > 0:
+            to_download = [(v['dataset_id'], v['variable']) for v in six.itervalues(results) if v['misses'] > 0]
+            f = render_request(to_download, prefix='request-%s'%name,
+                    search_url=query['search_url'], index=index)
+            print_request_written(f)
+
+    print(memo.summary())
+
+if __name__ == '__main__':
+    cli()
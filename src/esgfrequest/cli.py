@@ -16,17 +16,17 @@
 from __future__ import print_function
 import argparse
 from itertools import islice
-from distutils.util import strtobool
-import esgfrequest.esgf as esgf
 import six
-import sqlite3
 import os
+import sys
+import time
 from datetime import datetime
-import requests
-import sqlalchemy
 import logging
 from . import logger
 
+# Heavy modules (requests, sqlalchemy, esgfrequest.esgf) are imported where
+# they are used, so that e.g. `esgfrequest --help` starts quickly
+
 text_facets = {
         'query': {},
         'title': {},
@@ -86,34 +86,59 @@ bool_facets = {
             },
         }
 
-def connect_db(user):
+mas_url = 'postgresql://130.56.244.107:5432/postgres'
+
+def connect_db(user, db=None, **pool_args):
+    """
+    Connect to the MAS database, or to a local SQLite mirror of it if `db`
+    is given
+
+    Raises IOError if `db` isn't a checksum database (SQLite would create
+    an empty one)
+    """
     from .db import connect, Session
-    connect('postgresql://130.56.244.107:5432/postgres', user)
+    if db is not None:
+        check_local_db(db)
+        connect('sqlite:///%s'%db, **pool_args)
+    else:
+        connect(mas_url, user, **pool_args)
     return Session()
 
-def search_for_matches(session, filename, checksum):
-    from .model import Checksum, Basename
-    from sqlalchemy import or_
-    partial = 0
-
-    q = (session
-            .query(Checksum.md5)
-            .filter(or_(Checksum.md5 == checksum, Checksum.sha256 == checksum))
-            .distinct()
-            )
-    exact = q.count()
+def check_local_db(path):
+    """
+    Raise IOError if `path` isn't a SQLite database with the checksum tables
+    """
+    import sqlite3
 
-    q = (session
-            .query(Basename.basename)
-            .filter(Basename.basename == filename)
-            .distinct()
-            )
-    partial = q.count()
+    if not os.path.isfile(path):
+        raise IOError("No such database: %s"%path)
+    conn = sqlite3.connect(path)
+    try:
+        tables = set(r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    except sqlite3.DatabaseError as e:
+        raise IOError("%s: %s"%(path, e))
+    finally:
+        conn.close()
+    if not set(['checksums', 'basenames']) <= tables:
+        raise IOError("%s is not a checksum database (see esgfrequest-mirror)"%path)
 
-    if exact == 1:
-        partial = 0
+def search_for_matches(session, filename, checksum):
+    from .match import classify
+    return classify(session, [(filename, checksum)])[0]
 
-    return (exact, partial)
+def strtobool(value):
+    """
+    Convert a string like 'yes' or 'false' to 1 or 0, as
+    distutils.util.strtobool (importing distutils is slow)
+    """
+    value = value.lower()
+    if value in ['y', 'yes', 't', 'true', 'on', '1']:
+        return 1
+    elif value in ['n', 'no', 'f', 'false', 'off', '0']:
+        return 0
+    else:
+        raise ValueError("invalid truth value %r"%value)
 
 def bool_or_all_arg(value):
     try:
@@ -178,9 +203,65 @@ def cli():
             help="Maximum number of files to search",
             type=int,
             default=1000)
+    parser.add_argument('--rate',
+            help="Most search requests per second to each index node",
+            type=float,
+            default=20)
     parser.add_argument('--user',
             help="Username to connect to the database",
             default=os.environ['USER'])
+    parser.add_argument('--db',
+            help="Match against a local SQLite mirror (from esgfrequest-mirror) instead of MAS")
+    parser.add_argument('--pool_size',
+            help="Number of database connections to keep open",
+            type=int)
+    parser.add_argument('--max_overflow',
+            help="Number of database connections allowed beyond --pool_size",
+            type=int)
+    parser.add_argument('--pool_recycle',
+            help="Reconnect database connections older than this many seconds",
+            type=int)
+    parser.add_argument('--pool_pre_ping',
+            help="Test database connections before use (true, default), or not (false)",
+            type=strtobool,
+            default=True)
+    parser.add_argument('--format',
+            help="Write results as a table (default) or as jsonl, csv or parquet "
+            "rows for each dataset and variable as soon as they are complete",
+            choices=['table', 'jsonl', 'csv', 'parquet'],
+            default='table')
+    parser.add_argument('--output',
+            help="File to write --format results to (default stdout)",
+            default='-')
+    parser.add_argument('--replicas',
+            help="Search all replicas of requested files, and use the fastest data node",
+            action='store_true')
+    parser.add_argument('--node_speeds',
+            help="JSON file of data node throughputs ({hostname: MB/s}) for --replicas, "
+            "other nodes are measured")
+    parser.add_argument('--plan',
+            help="Estimate how long the missing files will take to download from "
+            "each data node (using --node_speeds, or measuring with --measure)",
+            action='store_true')
+    parser.add_argument('--measure',
+            help="Measure the speed of each data node for --plan",
+            action='store_true')
+    parser.add_argument('--window',
+            help="Hours available for downloading, checked by --plan",
+            type=float)
+    parser.add_argument('--processes',
+            help="Classify files using this many worker processes",
+            type=int)
+    parser.add_argument('--versions',
+            help="Show the local and latest versions of partially matched datasets",
+            action='store_true')
+    parser.add_argument('--single_stage',
+            help="Search for files directly instead of searching for datasets first, "
+            "falling back to a dataset search if the index node can't",
+            action='store_true')
+    parser.add_argument('--no_dataset_index',
+            help="Don't use or update the stored file lists of versioned datasets",
+            action='store_true')
     parser.add_argument('--debug',
             help="Print logging information",
             action='store_true')
@@ -188,64 +269,276 @@ def cli():
     args = vars(parser.parse_args())
 
     limit = args.pop('limit')
+    processes = args.pop('processes')
+    format = args.pop('format')
+    output = args.pop('output')
+    replicas = args.pop('replicas')
+    node_speeds = args.pop('node_speeds')
+    plan = args.pop('plan')
+    measure = args.pop('measure')
+    window = args.pop('window')
+    no_dataset_index = args.pop('no_dataset_index')
+    versions = args.pop('versions')
+    single_stage = args.pop('single_stage')
+    rate = args.pop('rate')
+    pool_args = {k: args.pop(k) for k in
+            ['pool_size', 'max_overflow', 'pool_recycle', 'pool_pre_ping']}
 
     if args.pop('debug'):
         logging.basicConfig()
         logger.setLevel(logging.DEBUG)
 
+    # Check before asking for the database password
+    if format == 'parquet':
+        if output == '-':
+            parser.error("--format parquet needs an --output file")
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--format parquet needs the pyarrow package "
+                    "(pip install esgfrequest[parquet])")
+
     args = handle_negative_facets(args, text_facets)
 
+    from . import throttle
+    throttle.set_rate(rate)
+
+    import requests
+    import sqlalchemy
+
     try:
-        cursor = connect_db(user=args.pop('user'))
-    except sqlalchemy.exc.OperationalError as e:
+        cursor = connect_db(user=args.pop('user'), db=args.pop('db'), **pool_args)
+    except (sqlalchemy.exc.OperationalError, IOError) as e:
         print("\nError connecting to MAS database:")
         print(e)
         return -1
 
+    from .memo import SearchMemo, DatasetIndex, default_dataset_index_path
+    dataset_index = None
+    if not no_dataset_index:
+        dataset_index = DatasetIndex(default_dataset_index_path())
+    memo = SearchMemo(index=dataset_index)
+
+    writer = None
+    if format != 'table':
+        from .output import open_writer
+        writer = open_writer(format, output)
+
+    planner = None
+    if plan:
+        from .plan import TransferPlanner
+        planner = TransferPlanner()
+
     try:
-        results, count = search_esgf(args, limit, cursor)
+        results, count = search_esgf(args, limit, cursor, memo=memo,
+                processes=processes, writer=writer, planner=planner,
+                single_stage=single_stage)
 
     except requests.exceptions.Timeout as e:
         print("\n\nRequest timed out")
         print(e.request.url)
         return -1
 
-    print_results(results, count, limit)
+    logger.info(memo.summary())
+    from .esgf import single_flight
+    logger.info(single_flight.summary())
+
+    if planner is not None:
+        from .plan import print_plan
+        from .replicas import load_speeds
+        speeds = load_speeds(node_speeds) if node_speeds is not None else {}
+        print_plan(planner.plan(speeds, measure=measure),
+                window * 3600 if window is not None else None)
+        return
+
+    if writer is not None:
+        if count == limit:
+            print("Reached maximum file limit (%d), some matches may be missing"%limit,
+                    file=sys.stderr)
+        return
+
+    from .table import ResultTable
+    table = ResultTable.from_results(results)
+
+    print_results(table, count, limit)
+
+    if versions:
+        from .versions import version_report, print_versions
+        partial = [i for i, v in table.downloads('partial')]
+        if partial:
+            print_versions(version_report(cursor, partial, args.get('search_url')))
+
+    from .pending import RequestIndex, default_index_path
+    request_args = {'index': RequestIndex(default_index_path())}
+    request_args['index'].prune()
+    if replicas:
+        from .replicas import NodeRanking, load_speeds
+        speeds = load_speeds(node_speeds) if node_speeds is not None else {}
+        request_args['ranking'] = NodeRanking(speeds, measure=True)
+
+    make_request(table, search_url=args.get('search_url'), **request_args)
+
+def mirror_cli():
+    parser = argparse.ArgumentParser(description="""
+    Copy the MAS checksum tables to a local SQLite file, which can then be
+    used for matching without any network access:
 
-    make_request(results)
+        esgfrequest-mirror ~/mas.db
+        esgfrequest --db ~/mas.db --model ACCESS1.0
 
-def search_esgf(args, limit, cursor):
+    Stop any searches using an existing mirror before replacing it.
+    """,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path',
+            help="SQLite file to write")
+    parser.add_argument('--user',
+            help="Username to connect to the database",
+            default=os.environ['USER'])
+    args = parser.parse_args()
 
-    g = esgf.search_dataset_files_generator(fields=['dataset_id', 'variable', 'title', 'checksum', 'size'], **args)
-    results = {}
-    count = 0
-    for doc in islice(g,limit):
-        key = doc['dataset_id'] + ' ' + doc['variable'][0]
-        r = results.get(key, {'matches':0,'misses':0, 'size':0, 'partial':0})
+    import sqlalchemy
+    from .db import connect, mirror
+    try:
+        engine = connect(mas_url, args.user)
+    except sqlalchemy.exc.OperationalError as e:
+        print("\nError connecting to MAS database:")
+        print(e)
+        return -1
+
+    count = mirror(engine, args.path)
+    print("Copied %d rows to %s"%(count, args.path))
+
+# Fields needed from each file doc by aggregate()
+result_fields = ['dataset_id', 'variable', 'title', 'checksum', 'size']
+
+def search_esgf(args, limit, cursor, batch_size=250, memo=None, processes=None,
+        writer=None, planner=None, single_stage=False):
+    """
+    Search ESGF for files matching `args`, and classify them against the
+    checksum database
 
-        exact, partial = search_for_matches(cursor, doc['title'], doc['checksum'][0])
+    If `memo` is a :class:`esgfrequest.memo.SearchMemo` dataset file lists
+    and classifications are shared with other searches using the same memo
 
-        # NCI files are always local
-        if doc['dataset_id'].endswith('esgf.nci.org.au'):
-            exact, partial = 1, 0
+    If `processes` is given the files are classified and totalled by that
+    many worker processes (see :func:`esgfrequest.parallel.aggregate_processes`),
+    each with their own database connection
 
-        r['matches'] += exact
-        r['misses'] += 1 - exact - partial
-        r['partial'] += partial
-        r['size'] += doc['size']
-        r['dataset_id'] = doc['dataset_id']
-        r['variable'] = doc['variable'][0]
-        results[key] = r
-        count += 1
+    If `writer` is given (see :func:`esgfrequest.output.open_writer`) the
+    totals for each dataset and variable are written to it as soon as the
+    dataset is complete, and it is closed at the end of the search. Like
+    `planner` this is done in this process even if `processes` is set
+
+    If `planner` is a :class:`esgfrequest.plan.TransferPlanner` the missing
+    files are also totalled by data node. This needs the file URLs, and is
+    done in this process even if `processes` is set
+
+    If `single_stage` is True files are searched for directly (see
+    :func:`esgfrequest.esgf.search_files_single_stage_generator`) rather
+    than by dataset. `memo` is then only used for classifications
+
+    Returns (results, count), results having the totals for each dataset
+    and variable
+    """
+    from . import esgf
+
+    results = {}
+    stream = None
+    if writer is not None:
+        from .output import ResultStream
+        stream = ResultStream(results, writer)
+        args = dict(args, on_datasets_done=stream.datasets_done)
+
+    fields = result_fields
+    callbacks = []
+    if stream is not None:
+        callbacks.append(stream.batch_done)
+    if planner is not None:
+        fields = result_fields + ['url']
+        callbacks.append(planner.add_batch)
+
+    def after_batch(batch, classified):
+        for c in callbacks:
+            c(batch, classified)
+
+    if single_stage:
+        g = esgf.search_files_single_stage_generator(fields=fields, **args)
+    elif memo is not None:
+        g = memo.dataset_files_generator(fields=fields, **args)
+    else:
+        g = esgf.search_dataset_files_generator(fields=fields, **args)
+
+    if processes and len(callbacks) == 0:
+        from .parallel import aggregate_processes, engine_url
+        count = aggregate_processes(islice(g,limit), engine_url(cursor),
+                results, processes, batch_size)
+    else:
+        count = aggregate(islice(g,limit), cursor, results, batch_size, memo,
+                after_batch=after_batch if callbacks else None)
+
+    if stream is not None:
+        stream.close()
 
     # Print a newline after the progress bar
-    print()
+    print(file=sys.stderr)
     return results, count
 
+def result_key(doc):
+    """
+    Key of the `results` entry the file `doc` is counted in
+    """
+    return doc['dataset_id'] + ' ' + doc['variable'][0]
+
+def aggregate(docs, cursor, results, batch_size=250, memo=None, after_batch=None):
+    """
+    Classify file `docs` against the checksum database, adding totals for
+    each dataset and variable to `results`
+
+    `after_batch` is called with each batch of docs once it has been
+    added to `results`, along with a list of (exact, partial) matches for
+    each doc
+
+    Returns the number of docs processed
+    """
+    from .match import chunks, classify
+
+    if memo is not None:
+        classify = memo.classify
+
+    count = 0
+    for batch in chunks(docs, batch_size):
+        matches = classify(cursor, [(doc['title'], doc['checksum'][0]) for doc in batch])
+
+        classified = []
+        for doc, (exact, partial) in zip(batch, matches):
+            key = result_key(doc)
+            r = results.get(key, {'matches':0,'misses':0, 'size':0, 'partial':0})
+
+            # NCI files are always local
+            if doc['dataset_id'].endswith('esgf.nci.org.au'):
+                exact, partial = 1, 0
+            classified.append((exact, partial))
+
+            r['matches'] += exact
+            r['misses'] += 1 - exact - partial
+            r['partial'] += partial
+            r['size'] += doc['size']
+            r['dataset_id'] = doc['dataset_id']
+            r['variable'] = doc['variable'][0]
+            results[key] = r
+            count += 1
+
+        if after_batch is not None:
+            after_batch(batch, classified)
+
+    return count
+
 def print_results(results, count, limit):
+    from .table import as_table
+    table = as_table(results)
 
     print("local\tpartial\tmissing\t\tsize\tid")
-    for k, v in six.iteritems(results):
+    for k, v in table.rows():
         name = k
         if v['partial'] > 0:
             name = "\u001b[33m%s\u001b[39;49m"%k
@@ -257,42 +550,42 @@ def print_results(results, count, limit):
     if count == limit:
         print("Reached maximum file limit (%d), some matches may be missing"%limit)
 
-    total_misses = sum([v['misses'] for v in six.itervalues(results)])
-    missing_size = sum([v['size'] if v['misses'] > 0 else 0 for v in six.itervalues(results)])
-
-    total_partial = sum([v['partial'] for v in six.itervalues(results)])
-    partial_size = sum([v['size'] if v['partial'] > 0 else 0 for v in six.itervalues(results)])
+    summary = table.summary()
 
     print()
     print("Partial matches: % 4d files, %s (e.g. different versions)"%(
-        total_partial,
-        size_str(partial_size))
+        summary['total_partial'],
+        size_str(summary['partial_size']))
         )
     print("Missing files:   % 4d files, %s"%(
-        total_misses, size_str(missing_size)))
-
-def make_request(results):
-    total_misses = sum([v['misses'] for v in six.itervalues(results)])
-    missing_size = sum([v['size'] if v['misses'] > 0 else 0 for v in six.itervalues(results)])
+        summary['total_misses'], size_str(summary['missing_size'])))
 
-    total_partial = sum([v['partial'] for v in six.itervalues(results)])
-    partial_size = sum([v['size'] if v['partial'] > 0 else 0 for v in six.itervalues(results)])
+def make_request(results, search_url=None, **request_args):
+    from .table import as_table
+    table = as_table(results)
+    summary = table.summary()
 
-    if total_misses > 0:
-        request_download = input_bool("\nSubmit a request for %s of missing data? (yes/[no]) "%(size_str(missing_size)))
+    if summary['total_misses'] > 0:
+        request_download = input_bool("\nSubmit a request for %s of missing data? (yes/[no]) "%(size_str(summary['missing_size'])))
         if request_download:
-            to_download = [(v['dataset_id'], v['variable']) for v in six.itervalues(results) if v['misses'] > 0]
-            f = render_request(to_download, prefix='request')
-            print("\nRequest written to %s"%f)
+            f = render_request(table.downloads('misses'), prefix='request',
+                    search_url=search_url, **request_args)
+            print_request_written(f)
 
-    if total_partial > 0:
-        request_update = input_bool("\nRequest updates for  %s of partial matches? (yes/[no]) "%(size_str(partial_size)))
+    if summary['total_partial'] > 0:
+        request_update = input_bool("\nRequest updates for  %s of partial matches? (yes/[no]) "%(size_str(summary['partial_size'])))
         if request_update:
-            to_download = [(v['dataset_id'], v['variable']) for v in six.itervalues(results) if v['partial'] > 0]
-            f = render_request(to_download, prefix='update')
-            print("\nRequest written to %s"%f)
+            f = render_request(table.downloads('partial'), prefix='update',
+                    search_url=search_url, **request_args)
+            print_request_written(f)
 
 
+def print_request_written(requestfile):
+    if requestfile is None:
+        print("\nAll files have already been requested")
+    else:
+        print("\nRequest written to %s"%requestfile)
+
 def input_bool(prompt, default=False):
     r = input(prompt)
     try:
@@ -307,16 +600,103 @@ def request_missing(results, request_partial):
 
 requestdir = os.environ['HOME']
 
-def render_request(to_download, prefix):
-    requestfile = os.path.join(requestdir, '_'.join([prefix, os.environ['USER'], datetime.now().strftime("%Y%m%dT%H%M") + '.txt']))
-    with open(requestfile, 'w') as f:
-        for val in to_download:
-            docs = esgf.search_files_generator(dataset_id = val[0], variable= val[1], fields=['title', 'url', 'checksum_type', 'checksum'])
-            for d in docs:
-                url = [u[0] for u in [u.split('|') for u in d['url']] if u[2] == 'HTTPServer'][0]
-                f.write("'%s' '%s' '%s' '%s'\n"%(d['title'], url, d['checksum_type'][0], d['checksum'][0]))
+def render_request(to_download, prefix, search_url=None, workers=8, ranking=None,
+        fallbacks=2, index=None):
+    """
+    Write a request file listing the files of each (dataset_id, variable)
+    in `to_download`
+
+    File lists are searched for by `workers` threads at once, and written
+    in the order of `to_download`
+
+    If `ranking` is a :class:`esgfrequest.replicas.NodeRanking` all replicas
+    of each file are considered, and the URL on the fastest data node is
+    written followed by up to `fallbacks` alternatives
+
+    If `index` is a :class:`esgfrequest.pending.RequestIndex` files that
+    are already pending in another request are left out, and the new files
+    are added to it
+
+    Returns the path of the request file, or None if there was nothing new
+    to request
+    """
+    from . import esgf
+    from concurrent.futures import ThreadPoolExecutor
+
+    if search_url is None:
+        search_url = esgf.default_search_url
+
+    def fetch(val):
+        docs = list(esgf.search_files_generator(dataset_id = val[0], variable= val[1],
+                fields=['title', 'url', 'checksum_type', 'checksum', 'instance_id', 'size'],
+                search_url=search_url, quiet=True))
+        if ranking is None:
+            return [(d, request_line(d)) for d in docs]
+
+        from .replicas import select_urls
+        urls = select_urls(docs, ranking, search_url, fallbacks)
+        return [(d, request_line(d, u)) for d, u in zip(docs, urls)]
+
+    base = os.path.join(requestdir, '_'.join([prefix, os.environ['USER'], datetime.now().strftime("%Y%m%dT%H%M")]))
+    requestfile = base + '.txt'
+    n = 1
+    while os.path.exists(requestfile):
+        # Don't overwrite a request made in the same minute
+        requestfile = '%s_%d.txt'%(base, n)
+        n += 1
+    start = time.time()
+    nfiles = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, \
+            open(requestfile, 'w', buffering=1024*1024) as f:
+        for i, lines in enumerate(ordered_map(pool, fetch, to_download, workers * 2), 1):
+            if index is not None:
+                pending = index.pending(d['checksum'][0] for d, l in lines)
+                lines = [(d, l) for d, l in lines if d['checksum'][0] not in pending]
+                index.add((d['checksum'][0], requestfile, d['title'], d.get('size'))
+                        for d, l in lines)
+            f.writelines(l for d, l in lines)
+            nfiles += len(lines)
+            elapsed = time.time() - start
+            print("\r%d/%d datasets, %d files, %.0f files/s"%(
+                i, len(to_download), nfiles, nfiles / max(elapsed, 1e-6)),
+                end='', file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+
+    if nfiles == 0:
+        os.remove(requestfile)
+        return None
     return requestfile
 
+def request_line(doc, urls=None):
+    """
+    Line of a request file for the file `doc`:
+
+        'title' 'url' 'checksum_type' 'checksum'
+
+    If `urls` is given the first is used as the download URL, and the rest
+    are appended as fallbacks
+    """
+    if urls is None:
+        urls = [u[0] for u in [u.split('|') for u in doc['url']] if u[2] == 'HTTPServer'][:1]
+    fields = [doc['title'], urls[0], doc['checksum_type'][0], doc['checksum'][0]] + urls[1:]
+    return ' '.join("'%s'"%f for f in fields) + '\n'
+
+def ordered_map(pool, f, iterable, ahead):
+    """
+    Like `pool.map(f, iterable)`, but with at most `ahead` calls submitted
+    and not yet consumed, so results don't pile up in memory behind a slow
+    call
+    """
+    from collections import deque
+
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(f, item))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 
 def size_str(size):
     from math import log, floor
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Precomputed local coverage of datasets
+
+The totals :func:`esgfrequest.cli.search_esgf` produces for each dataset and
+variable are stored in a SQLite table, so how much of a dataset is held
+locally is a single indexed lookup rather than a search.
+
+    esgfrequest-coverage --refresh queries.jsonl
+    esgfrequest-coverage cmip5.output1.CSIRO-BOM.ACCESS1-0.historical.mon.atmos.Amon.r1i1p1.v20120115|aims3.llnl.gov
+
+Refreshing still lists the files of every matching dataset (from the
+dataset index where it can), but only classifies the files of datasets that
+aren't already complete locally, as a complete versioned dataset stays
+complete.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from itertools import islice
+from .match import chunks
+
+columns = ['dataset_id', 'variable', 'matches', 'partial', 'misses', 'size', 'updated']
+
+class CoverageStore(object):
+    """
+    Table of the matches, partial matches, misses and total size of each
+    dataset and variable
+
+    The store may be shared between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS coverage (
+                dataset_id TEXT,
+                variable TEXT,
+                matches INTEGER,
+                partial INTEGER,
+                misses INTEGER,
+                size INTEGER,
+                updated REAL,
+                PRIMARY KEY (dataset_id, variable)
+            )""")
+        self.conn.commit()
+
+    def get(self, dataset_ids):
+        """
+        Returns the stored rows (as dicts) of `dataset_ids`
+        """
+        rows = []
+        with self._lock:
+            for batch in chunks(sorted(set(dataset_ids)), 500):
+                q = self.conn.execute(
+                        "SELECT %s FROM coverage WHERE dataset_id IN (%s)"%(
+                            ', '.join(columns), ','.join('?' * len(batch))), batch)
+                rows.extend(dict(zip(columns, r)) for r in q)
+        return rows
+
+    def complete(self):
+        """
+        Returns the set of (dataset_id, variable) with every file held
+        locally
+        """
+        with self._lock:
+            q = self.conn.execute(
+                    "SELECT dataset_id, variable FROM coverage WHERE misses = 0 AND partial = 0")
+            return set(q)
+
+    def update(self, results):
+        """
+        Store the rows of a results dict from
+        :func:`esgfrequest.cli.search_esgf`
+        """
+        now = time.time()
+        rows = [(r['dataset_id'], r['variable'], r['matches'], r['partial'],
+            r['misses'], r['size'], now) for r in results.values()]
+        with self._lock:
+            self.conn.executemany(
+                    "INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def default_coverage_path():
+    from .cli import requestdir
+    return os.path.join(requestdir, '.esgfrequest_coverage.db')
+
+def refresh(store, args, cursor, limit=None, batch_size=250, memo=None, full=False):
+    """
+    Search for the datasets matching `args` and update their coverage in
+    `store`
+
+    Unless `full` is set, datasets already complete in the store are left
+    as they are. Their files are still listed, but not classified again
+
+    Returns the number of files classified
+    """
+    from . import esgf
+    from .cli import aggregate, result_fields, result_key
+
+    if memo is not None:
+        g = memo.dataset_files_generator(fields=result_fields, **args)
+    else:
+        g = esgf.search_dataset_files_generator(fields=result_fields, **args)
+
+    if not full:
+        complete = set(' '.join(k) for k in store.complete())
+        g = (d for d in g if result_key(d) not in complete)
+
+    results = {}
+    count = aggregate(islice(g, limit), cursor, results, batch_size, memo)
+    store.update(results)
+
+    # Print a newline after the progress bar
+    print(file=sys.stderr)
+    return count
+
+def print_coverage(rows):
+    from .cli import size_str
+
+    print("local\tpartial\tmissing\t\tsize\tid")
+    for r in rows:
+        print("%d\t%d\t%d\t%s\t%s %s"%(r['matches'], r['partial'], r['misses'],
+            size_str(r['size']), r['dataset_id'], r['variable']))
+
+def cli():
+    parser = argparse.ArgumentParser(description="""
+    Look up the stored local coverage of datasets, or refresh it by running
+    searches from a JSONL query file (see esgfrequest-batch)
+    """)
+    parser.add_argument('dataset_ids', nargs='*',
+            help="Datasets to look up")
+    parser.add_argument('--refresh',
+            help="JSONL query file of datasets to update")
+    parser.add_argument('--full',
+            help="Update datasets that are already complete too",
+            action='store_true')
+    parser.add_argument('--store',
+            help="Coverage database",
+            default=default_coverage_path())
+    parser.add_argument('--user',
+            help="Username to connect to the database",
+            default=os.environ['USER'])
+    parser.add_argument('--db',
+            help="Match against a local SQLite mirror (from esgfrequest-mirror) instead of MAS")
+    args = parser.parse_args()
+
+    store = CoverageStore(args.store)
+
+    if args.refresh is not None:
+        import sqlalchemy
+        from .batch import load_queries
+        from .cli import connect_db
+        from .memo import SearchMemo, DatasetIndex, default_dataset_index_path
+
+        try:
+            cursor = connect_db(user=args.user, db=args.db)
+        except (sqlalchemy.exc.OperationalError, IOError) as e:
+            print("\nError connecting to MAS database:")
+            print(e)
+            return -1
+
+        memo = SearchMemo(index=DatasetIndex(default_dataset_index_path()))
+        for name, query in load_queries(args.refresh):
+            count = refresh(store, query, cursor, memo=memo, full=args.full)
+            print("%s: %d files checked"%(name, count))
+
+    if args.dataset_ids:
+        print_coverage(store.get(args.dataset_ids))
+    store.close()
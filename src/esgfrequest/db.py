@@ -15,25 +15,59 @@
 # limitations under the License.
 from __future__ import print_function
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, Index, MetaData, text
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.engine.url import make_url
 from getpass import getpass
+import os
+import six
 
-Session = sessionmaker()
+# Thread-local sessions, so that worker threads each get their own
+# connection from the engine's pool
+Session = scoped_session(sessionmaker())
 
 
-def connect(url, user=None, debug=False, init=False, session=Session):
+def connect(url, user=None, debug=False, init=False, session=Session,
+        pool_size=None, max_overflow=None, pool_recycle=None,
+        pool_pre_ping=True):
     """
-    Returns a sqlalchemy.Connection
+    Configures `session` to use a pooled engine connected to `url`
+
+    Pool options left as None use the SQLAlchemy defaults. `pool_pre_ping`
+    tests connections as they are checked out of the pool, so that
+    connections dropped by the server are transparently replaced.
+
+    Returns a sqlalchemy.Engine
     """
     _url = make_url(url)
 
     if user is not None:
-        _url.username = user
-        _url.password = getpass("Password for %s: "%user)
+        password = getpass("Password for %s: "%user)
+        try:
+            _url = _url.set(username=user, password=password)
+        except AttributeError:
+            # SQLAlchemy < 1.4 has a mutable URL
+            _url.username = user
+            _url.password = password
+
+    pool_args = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_recycle': pool_recycle,
+            }
+    pool_args = {k: v for k, v in pool_args.items() if v is not None}
+
+    if (pool_args and _url.get_backend_name() == 'sqlite' and
+            _url.database not in (None, '', ':memory:')):
+        # SQLAlchemy < 2.0 doesn't pool SQLite file connections by default
+        from sqlalchemy.pool import QueuePool
+        pool_args['poolclass'] = QueuePool
 
-    engine = create_engine(_url, echo=debug)
+    engine = create_engine(_url, echo=debug, pool_pre_ping=pool_pre_ping,
+            **pool_args)
+
+    # Check the database is reachable now rather than on first query
+    engine.connect().close()
 
     if init:
         from .model import Base
@@ -41,4 +75,116 @@ def connect(url, user=None, debug=False, init=False, session=Session):
 
     session.configure(bind=engine)
 
-    return engine.connect()
+    return engine
+
+
+def mirror(source, path, batch_size=10000):
+    """
+    Copy the checksums and basenames tables from the engine `source` into a
+    SQLite database at `path`, for fast local matching
+
+    The mirror is built in a temporary file which then replaces `path`, so
+    `path` is never left half written. It uses WAL mode and is indexed on
+    the columns used by :mod:`esgfrequest.match`.
+
+    Stop any searches reading an existing mirror at `path` first, its WAL
+    and shared memory files are removed when it is replaced.
+
+    Returns the number of rows copied
+    """
+    from .model import Base, Checksum, Basename
+
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    dest = create_engine('sqlite:///%s'%tmp)
+    Base.metadata.create_all(dest)
+
+    count = 0
+    with source.connect() as src, dest.begin() as dst:
+        for table in [Checksum.__table__, Basename.__table__]:
+            keys = table.c.keys()
+            result = src.execute(table.select().execution_options(stream_results=True))
+            while True:
+                rows = result.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                dst.execute(table.insert(),
+                        [dict(zip(keys, (_text(v) for v in row))) for row in rows])
+                count += len(rows)
+
+    # Indexes are built after loading, which is much faster than maintaining
+    # them during the inserts
+    for index in match_indexes():
+        index.create(dest, checkfirst=True)
+
+    with dest.connect() as conn:
+        conn.execute(text('PRAGMA journal_mode=WAL'))
+        conn.execute(text('ANALYZE'))
+    dest.dispose()
+
+    # Don't let the old database's WAL be applied to the new one
+    for suffix in ['-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(tmp, path)
+    return count
+
+_match_indexes = None
+
+def match_indexes():
+    """
+    Indexes on the columns used by :mod:`esgfrequest.match`, create them
+    with `index.create(engine, checkfirst=True)`
+
+    The indexes are on copies of the tables in their own MetaData, so
+    creating the tables of :data:`esgfrequest.model.Base` (e.g. in MAS)
+    doesn't create them as well
+    """
+    global _match_indexes
+    if _match_indexes is None:
+        from .model import Checksum, Basename
+        metadata = MetaData()
+        checksums = _copy_table(Checksum.__table__, metadata)
+        basenames = _copy_table(Basename.__table__, metadata)
+        _match_indexes = [
+                Index('ix_checksums_md5', checksums.c.ch_md5),
+                Index('ix_checksums_sha256', checksums.c.ch_sha256),
+                Index('ix_basenames_basename', basenames.c.basename),
+                ]
+    return _match_indexes
+
+def _copy_table(table, metadata):
+    try:
+        return table.to_metadata(metadata)
+    except AttributeError:
+        # SQLAlchemy < 1.4
+        return table.tometadata(metadata)
+
+def _text(value):
+    # Postgres UUIDs may come back as uuid.UUID
+    if value is None or isinstance(value, six.string_types):
+        return value
+    return str(value)
+
+def add_files(session, files):
+    """
+    Record local files in the checksum database, so that they are matched
+    by :mod:`esgfrequest.match`
+
+    `files` is a list of (basename, md5, sha256), either checksum may be
+    None. The caller commits the session.
+
+    Returns the ids of the new entries
+    """
+    import uuid
+    from .model import Checksum, Basename
+
+    ids = []
+    for basename, md5, sha256 in files:
+        id = str(uuid.uuid4())
+        session.add(Checksum(id=id, md5=md5, sha256=sha256))
+        session.add(Basename(id=id, basename=basename))
+        ids.append(id)
+    return ids
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Downloading the files listed in request files
+
+Files are fetched by a pool of threads, with a limit on the connections
+open to each data node. Each file is written to a '.part' file and
+checksummed as it arrives; an interrupted download is resumed with an HTTP
+Range request, and the file only gets its real name once its checksum has
+been verified. Fallback URLs are tried in turn if a download fails. A file
+already in the destination is only skipped if its checksum matches, as
+different versions of a file have the same name.
+
+    esgfrequest-download --dest /g/data/downloads ~/request_*.txt
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import sys
+import threading
+from .pending import RequestIndex, default_index_path, read_request
+from .replicas import data_node
+from .verify import DigestCache, default_cache_path, file_digests
+
+chunk_size = 1024*1024
+
+class HostLimiter(object):
+    """
+    Limits the number of connections open to each host to `per_host`
+    """
+    def __init__(self, per_host=2):
+        self.per_host = per_host
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        host = data_node(url)
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+class ChecksumError(Exception):
+    pass
+
+def fetch(url, part, checksum_type, timeout=60):
+    """
+    Download `url` to the file `part`, continuing from the end of `part` if
+    it already exists
+
+    Returns the hex digest of the whole file
+    """
+    from .esgf import http_session
+
+    h = hashlib.new(checksum_type.lower())
+    offset = 0
+    if os.path.exists(part):
+        # Only the part already downloaded needs to be read back
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                h.update(block)
+                offset += len(block)
+
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-'%offset
+
+    r = http_session().get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        if r.status_code == 416:
+            # Nothing left to download
+            return h.hexdigest()
+        r.raise_for_status()
+
+        mode = 'ab'
+        if r.status_code != 206:
+            # The server sent the whole file
+            h = hashlib.new(checksum_type.lower())
+            mode = 'wb'
+
+        with open(part, mode) as f:
+            for block in r.iter_content(chunk_size):
+                f.write(block)
+                h.update(block)
+    finally:
+        r.close()
+
+    return h.hexdigest()
+
+def existing_digest(path, checksum_type, cache=None):
+    """
+    Digest of the existing file `path`, looked up in the
+    :class:`esgfrequest.verify.DigestCache` `cache` if it hasn't changed
+    """
+    t = checksum_type.lower()
+    st = os.stat(path)
+    key = (path, t, st.st_size, st.st_mtime)
+    if cache is not None:
+        cached = cache.get([key])
+        if (path, t) in cached:
+            return cached[(path, t)]
+
+    digest = file_digests(path, (t,))[t]
+    if cache is not None:
+        cache.add([key + (digest,)])
+    return digest
+
+def download_file(fields, dest, limiter, timeout=60, cache=None):
+    """
+    Download the file described by a request file line's `fields` (title,
+    url, checksum_type, checksum, fallback urls...) into the directory
+    `dest`, recording its digest in the
+    :class:`esgfrequest.verify.DigestCache` `cache`
+
+    Returns (fields, error), error being None on success
+    """
+    title, url, checksum_type, checksum = fields[:4]
+
+    # The title comes from remote metadata, don't write outside of dest
+    if os.path.basename(title) != title or title in ('', '.', '..'):
+        return fields, ValueError("Invalid file name %r"%title)
+
+    path = os.path.join(dest, title)
+    part = path + '.part'
+
+    if os.path.exists(path):
+        try:
+            digest = existing_digest(path, checksum_type, cache)
+        except (IOError, OSError) as e:
+            return fields, e
+        if digest != checksum.lower():
+            # Most likely another version of the file
+            return fields, ChecksumError(
+                    "%s exists with a different %s checksum"%(path, checksum_type))
+        return fields, None
+
+    error = None
+    for u in [url] + fields[4:]:
+        try:
+            with limiter(u):
+                digest = fetch(u, part, checksum_type, timeout)
+            if digest != checksum.lower():
+                # Don't resume from a bad file
+                os.remove(part)
+                raise ChecksumError("%s checksum mismatch for %s"%(checksum_type, u))
+            os.rename(part, path)
+            if cache is not None:
+                st = os.stat(path)
+                cache.add([(path, checksum_type.lower(), st.st_size, st.st_mtime, digest)])
+            return fields, None
+        except Exception as e:
+            error = e
+    return fields, error
+
+def download(lines, dest, workers=8, per_host=2, timeout=60, cache=None):
+    """
+    Download the files of request file `lines` (from
+    :func:`esgfrequest.pending.read_request`) into `dest`, using `workers`
+    threads and at most `per_host` connections to each data node. Files
+    already in `dest` are checked against their checksums, with digests
+    cached in the :class:`esgfrequest.verify.DigestCache` `cache`
+
+    Returns a generator producing (fields, error) for each file as it
+    finishes, error being None on success
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    limiter = HostLimiter(per_host)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(download_file, fields, dest, limiter, timeout, cache)
+                for fields, line in lines]
+        for f in as_completed(futures):
+            yield f.result()
+
+def cli():
+    parser = argparse.ArgumentParser(description="""
+    Download the files listed in request files, verifying their checksums.
+    Partial downloads are resumed when run again.
+    """)
+    parser.add_argument('requests', nargs='+',
+            help="Request files to download")
+    parser.add_argument('--dest',
+            help="Directory to download to (default current directory)",
+            default='.')
+    parser.add_argument('--workers',
+            help="Number of files to download at once",
+            type=int,
+            default=8)
+    parser.add_argument('--per_host',
+            help="Most files to download from a single data node at once",
+            type=int,
+            default=2)
+    parser.add_argument('--db',
+            help="Record downloaded files in this local SQLite checksum database "
+            "(see esgfrequest-mirror), so later searches find them")
+    parser.add_argument('--index',
+            help="Pending request index, downloaded files are removed from it",
+            default=default_index_path())
+    parser.add_argument('--cache',
+            help="Digest cache of files already downloaded",
+            default=default_cache_path())
+    args = parser.parse_args()
+
+    lines = {}
+    for p in args.requests:
+        for fields, line in read_request(p):
+            lines.setdefault(fields[3], (fields, line))
+
+    session = None
+    if args.db is not None:
+        from .db import connect, Session
+        connect('sqlite:///%s'%args.db, init=True)
+        session = Session()
+
+    index = RequestIndex(args.index)
+    cache = DigestCache(args.cache)
+
+    failed = 0
+    done = 0
+    for fields, error in download(list(lines.values()), args.dest,
+            args.workers, args.per_host, cache=cache):
+        title, url, checksum_type, checksum = fields[:4]
+        if error is not None:
+            print("Failed %s: %s"%(title, error), file=sys.stderr)
+            failed += 1
+            continue
+
+        done += 1
+        print(title)
+        if session is not None:
+            from .db import add_files
+            from .match import classify
+            # Files already in the destination may have been recorded by
+            # an earlier run
+            [(exact, partial)] = classify(session, [(title, checksum)])
+            if not exact:
+                md5 = checksum if checksum_type.lower() == 'md5' else None
+                sha256 = checksum if checksum_type.lower() == 'sha256' else None
+                add_files(session, [(title, md5, sha256)])
+                session.commit()
+        index.remove([checksum])
+
+    index.close()
+    cache.close()
+    print("Downloaded %d files, %d failed"%(done, failed), file=sys.stderr)
+    return 1 if failed else 0
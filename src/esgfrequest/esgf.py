@@ -16,10 +16,45 @@
 from __future__ import print_function
 import requests
 import six
+import sys
+import time
 from . import logger
+from . import throttle
+from .flight import SingleFlight
+
+default_search_url = 'https://esgf.nci.org.au/esg-search/search'
+
+# Facets that are passed from a dataset search through to the file search in
+# search_dataset_files_generator()
+file_facets = ['variable', 'cf_standard_name', 'variable_long_name', 'distrib']
+
+# Facets that mean something different for files than for datasets, so
+# can't be used in a single stage file search
+dataset_facets = ['version', 'id', 'title', 'query']
+
+_http = None
+
+# Concurrent identical searches share one request, see search_raw()
+single_flight = SingleFlight()
+
+def http_session():
+    """
+    Returns the requests.Session shared by all searches, so connections to
+    the index nodes are kept alive between requests
+    """
+    global _http
+    if _http is None:
+        _http = requests.Session()
+    return _http
+
+def progress():
+    """
+    Print a progress dot, on stderr so that stdout can be used for results
+    """
+    print('.', end='', file=sys.stderr, flush=True)
 
 def search_raw(
-        search_url='https://esgf.nci.org.au/esg-search/search',
+        search_url=default_search_url,
         distrib=True,
         replica=None,
         latest=None,
@@ -52,7 +87,27 @@ def search_raw(
             except TypeError:
                 params[key] = value
 
-    r = requests.get(search_url, params=params, timeout=30)
+    # Identical searches running at the same time (e.g. from several batch
+    # queries or server clients) share one request. The decoded response
+    # is shared too, so must not be modified.
+    key = (search_url, tuple(sorted((k, repr(v)) for k, v in params.items()
+        if v is not None)))
+    return single_flight.do(key, lambda: _get(search_url, params))
+
+def _get(search_url, params, retries=3):
+    # Requests are limited per index node, and retried after a pause if
+    # the node is overloaded
+    t = throttle.for_url(search_url)
+    # Latency depends on how much is asked for, so only compare requests
+    # of the same shape
+    kind = (params.get('type'), params.get('limit'), params.get('fields'))
+    for attempt in range(retries + 1):
+        r = t.request(lambda: http_session().get(search_url, params=params, timeout=30),
+                kind)
+        if r.status_code not in (429, 503) or attempt == retries:
+            break
+        logger.info("Throttled by %s, retrying"%search_url)
+        time.sleep(throttle.retry_delay(r, attempt))
 
     logger.info("GET %s"%r.url)
 
@@ -64,10 +119,10 @@ def search_raw(
 def search_datasets(**kwargs):
     return search_raw(**kwargs)
 
-def search_files(fields=None, **kwargs):
+def search_files(**kwargs):
     return search_raw(type='File', **kwargs)
 
-def search_dataset_files(**kwargs):
+def search_dataset_files(fields=None, **kwargs):
     """
     Returns files that match given dataset constraints
     """
@@ -85,32 +140,52 @@ def search_datasets_generator(**kwargs):
 
     while True:
         r = search_datasets(offset=offset, limit=limit, **kwargs)
-        print('.',end='',flush=True)
+        progress()
 
-        for doc in r['response']['docs']:
+        docs = r['response']['docs']
+        if len(docs) == 0:
+            break
+
+        for doc in docs:
             yield doc
 
-        offset += limit
-        if r['response']['numFound'] < offset:
+        # Index nodes may return fewer docs than requested
+        offset += len(docs)
+        if r['response']['numFound'] <= offset:
             break
 
 
 def search_files_generator(**kwargs):
     """
     Returns a geneartor producing matching files
+
+    Pass `quiet=True` to not print progress dots. If `totals` is a dict its
+    'numFound' is set to the number of matching files the index node
+    reports, which is more than were produced if it returned an empty page
+    early
     """
     offset = 0
     limit = kwargs.pop('limit', 100)
+    quiet = kwargs.pop('quiet', False)
+    totals = kwargs.pop('totals', None)
 
     while True:
         r = search_files(offset=offset, limit=limit, **kwargs)
-        print('.',end='',flush=True)
+        if not quiet:
+            progress()
+        if totals is not None:
+            totals['numFound'] = r['response']['numFound']
 
-        for doc in r['response']['docs']:
+        docs = r['response']['docs']
+        if len(docs) == 0:
+            break
+
+        for doc in docs:
             yield doc
 
-        offset += limit
-        if r['response']['numFound'] < offset:
+        # Index nodes may return fewer docs than requested
+        offset += len(docs)
+        if r['response']['numFound'] <= offset:
             break
 
 
@@ -137,21 +212,79 @@ def search_dataset_files_generator(**kwargs):
     offset = 0
     limit = kwargs.pop('limit', 10)
     fields = kwargs.pop('fields', None)
+    on_datasets_done = kwargs.pop('on_datasets_done', None)
 
     while True:
         r = search_datasets(offset=offset, limit=limit, fields='id', **kwargs)
-        print('.',end='',flush=True)
+        progress()
 
-        ids = [d['id'] for d in r['response']['docs']]
+        docs = r['response']['docs']
+        ids = [d['id'] for d in docs]
+        if len(ids) == 0:
+            break
 
         for f in search_files_generator(dataset_id = ids, fields=fields,
-                    variable=kwargs.get('variable'),
-                    cf_standard_name=kwargs.get('cf_standard_name'),
-                    variable_long_name=kwargs.get('variable_long_name'),
-                    distrib=kwargs.get('distrib'),
-                    ):
+                    search_url=kwargs.get('search_url', default_search_url),
+                    **{k: kwargs.get(k) for k in file_facets}):
             yield f
 
-        offset += limit
-        if r['response']['numFound'] < offset:
+        if on_datasets_done is not None:
+            on_datasets_done(ids)
+
+        offset += len(docs)
+        if r['response']['numFound'] <= offset:
             break
+
+
+def search_files_single_stage_generator(**kwargs):
+    """
+    Returns a generator producing files that are part of matching datasets,
+    like :func:`search_dataset_files_generator` but using only File
+    searches
+
+    Dataset facets (model, experiment, latest, replica...) are also set on
+    each file, so the files can be searched for directly. The number of
+    files in each dataset is found first from a `dataset_id` facet count, so
+    that `on_datasets_done` can be called as soon as all the files of a
+    dataset have been seen, whatever order they arrive in.
+
+    Falls back to :func:`search_dataset_files_generator` if the search
+    uses a facet that only applies to datasets, or the index node doesn't
+    return complete facet counts
+    """
+    for k in dataset_facets:
+        for value in (kwargs.get(k), kwargs.get(k + '!')):
+            if value is not None and value != '*':
+                return search_dataset_files_generator(**kwargs)
+
+    args = dict(kwargs)
+    args.pop('limit', None)
+    fields = args.pop('fields', None)
+    on_datasets_done = args.pop('on_datasets_done', None)
+
+    try:
+        r = search_files(limit=0, facets='dataset_id', **args)
+        pairs = r['facet_counts']['facet_fields']['dataset_id']
+    except (requests.exceptions.HTTPError, KeyError):
+        logger.info("No dataset_id facet counts, using a dataset search")
+        return search_dataset_files_generator(**kwargs)
+
+    counts = dict(zip(pairs[::2], pairs[1::2]))
+    if sum(counts.values()) != r['response']['numFound']:
+        # Facet counts are truncated
+        logger.info("Incomplete dataset_id facet counts, using a dataset search")
+        return search_dataset_files_generator(**kwargs)
+
+    if fields is not None and 'dataset_id' not in fields:
+        fields = list(fields) + ['dataset_id']
+
+    return _single_stage(counts, on_datasets_done, fields=fields, **args)
+
+def _single_stage(counts, on_datasets_done, **kwargs):
+    for doc in search_files_generator(**kwargs):
+        yield doc
+
+        dataset_id = doc['dataset_id']
+        counts[dataset_id] = counts.get(dataset_id, 0) - 1
+        if counts[dataset_id] == 0 and on_datasets_done is not None:
+            on_datasets_done([dataset_id])
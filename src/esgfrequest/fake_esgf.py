@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A stand-in for an ESGF index node's search API, for testing and
+benchmarking without network access
+
+    with FakeESGF(datasets=10, files=5) as server:
+        esgf.search_raw(search_url=server.search_url, ...)
+
+Datasets and files are generated deterministically, with the same document
+shape as the real Solr responses for the fields esgfrequest uses.
+"""
+from __future__ import print_function
+import hashlib
+import json
+import threading
+import time
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse, parse_qs
+
+# Search parameters that aren't facet constraints
+control_params = ['distrib', 'limit', 'offset', 'sort', 'query', 'type',
+        'format', 'fields', 'facets']
+
+class FakeESGF(object):
+    """
+    Fake ESGF search server
+
+    Args:
+        datasets: Number of datasets
+        files: Number of files in each dataset
+        variables: Variable names, datasets are spread evenly between them
+        latency: Seconds to sleep before answering each request
+        max_limit: Maximum page size, larger requested limits are truncated
+        data_nodes: Hostnames of data nodes, datasets are spread evenly
+            between them
+        replica_nodes: Hostnames of data nodes that hold a replica of
+            every dataset
+        size: Size of each file in bytes
+        versions: Number of versions of each dataset, only the last is
+            latest. Files keep their names between versions but have
+            different checksums
+        facets: Return facet counts for the 'facets' parameter, as real
+            index nodes do
+    """
+    def __init__(self, datasets=10, files=10, variables=('tas', 'pr'),
+            latency=0, max_limit=10000,
+            data_nodes=('esgf.example.org',), replica_nodes=(), size=1000000,
+            versions=1, facets=True):
+        self.latency = latency
+        self.max_limit = max_limit
+        self.facets = facets
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        self.datasets = []
+        self.files = []
+        for i in range(datasets):
+            variable = variables[i % len(variables)]
+            node = data_nodes[i % len(data_nodes)]
+            master_id = 'cmip5.output1.INST.MODEL%d.historical.mon.atmos.Amon.r1i1p1'%i
+            for v in range(versions):
+                version = '%d0101'%(2012 + v)
+                latest = v == versions - 1
+                dataset_id = '%s.v%s|%s'%(master_id, version, node)
+                self.datasets.append({
+                    'id': dataset_id,
+                    'master_id': master_id,
+                    'instance_id': '%s.v%s'%(master_id, version),
+                    'version': version,
+                    'data_node': node,
+                    'variable': [variable],
+                    'latest': latest,
+                    'replica': False,
+                    })
+                for j in range(files):
+                    title = '%s_Amon_MODEL%d_historical_r1i1p1_%04d.nc'%(variable, i, j)
+                    instance_id = '%s.v%s.%s'%(master_id, version, title)
+                    self.files.append({
+                        'id': '%s|%s'%(instance_id, node),
+                        'instance_id': instance_id,
+                        'master_id': '%s.%s'%(master_id, title),
+                        'dataset_id': dataset_id,
+                        'data_node': node,
+                        'title': title,
+                        'variable': [variable],
+                        'checksum': [checksum(instance_id)],
+                        'checksum_type': ['SHA256'],
+                        'size': size,
+                        'url': [
+                            'http://%s/thredds/fileServer/%s|application/netcdf|HTTPServer'%(node, title),
+                            'gsiftp://%s:2811//%s|application/gridftp|GridFTP'%(node, title),
+                            ],
+                        'latest': latest,
+                        'replica': False,
+                        })
+
+        # Copies of everything on the replica nodes
+        for docs in [self.datasets, self.files]:
+            for doc in list(docs):
+                for node in replica_nodes:
+                    docs.append(_replica(doc, node))
+
+        self.server = None
+        self.thread = None
+
+    def search(self, params):
+        """
+        Answer a search request, `params` maps parameter names to lists of
+        values as from :func:`parse_qs`
+        """
+        with self._lock:
+            self.requests += 1
+
+        kind = params.get('type', ['Dataset'])[0]
+        docs = self.files if kind == 'File' else self.datasets
+
+        for key, values in params.items():
+            if key in control_params:
+                continue
+            values = [v for value in values for v in value.split(',')]
+            if key.endswith('!'):
+                docs = [d for d in docs if not _match(d, key[:-1], values)]
+            else:
+                docs = [d for d in docs if _match(d, key, values)]
+
+        offset = int(params.get('offset', [0])[0])
+        limit = min(int(params.get('limit', [10])[0]), self.max_limit)
+
+        page = docs[offset:offset+limit]
+        if 'fields' in params:
+            fields = params['fields'][0].split(',')
+            if '*' not in fields:
+                page = [{k: d[k] for k in fields if k in d} for d in page]
+
+        result = {
+                'responseHeader': {'status': 0, 'params': {k: v[0] for k, v in params.items()}},
+                'response': {'numFound': len(docs), 'start': offset, 'docs': page},
+                }
+
+        if self.facets and 'facets' in params:
+            counts = {}
+            for f in params['facets'][0].split(','):
+                values = {}
+                for d in docs:
+                    value = d.get(f, [])
+                    if not isinstance(value, list):
+                        value = [value]
+                    for v in value:
+                        values[v] = values.get(v, 0) + 1
+                # Solr's flat [value, count, value, count, ...] form
+                counts[f] = [x for v in sorted(values) for x in (v, values[v])]
+            result['facet_counts'] = {'facet_fields': counts}
+
+        return result
+
+    @property
+    def search_url(self):
+        return 'http://%s:%d/esg-search/search'%self.server.server_address
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if fake.latency > 0:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                body = json.dumps(fake.search(parse_qs(url.query))).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def checksum(instance_id):
+    """
+    Checksum the fake server gives the file `instance_id`
+    """
+    return hashlib.sha256(instance_id.encode('utf-8')).hexdigest()
+
+def _match(doc, key, values):
+    if key not in doc:
+        # Unknown facets don't constrain the fake results
+        return True
+    value = doc[key]
+    if isinstance(value, bool):
+        return any(str(value).lower() == v.lower() for v in values)
+    if not isinstance(value, list):
+        value = [value]
+    return any(str(v) in values for v in value)
+
+def _replica(doc, node):
+    r = dict(doc)
+    r['replica'] = True
+    r['data_node'] = node
+    r['id'] = doc['id'].replace(doc['data_node'], node)
+    if 'dataset_id' in doc:
+        r['dataset_id'] = doc['dataset_id'].replace(doc['data_node'], node)
+    if 'url' in doc:
+        r['url'] = [u.replace(doc['data_node'], node) for u in doc['url']]
+    return r
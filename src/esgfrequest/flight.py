@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sharing the work of identical calls made at the same time
+"""
+from __future__ import print_function
+import threading
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Runs a function once for any number of concurrent calls with the same
+    key, every caller getting the same result (or exception)
+
+    Calls are only shared while one is in flight, nothing is cached once it
+    has finished. `stats` counts the calls made and those that shared
+    another call's result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'calls': 0, 'coalesced': 0}
+
+    def do(self, key, f):
+        """
+        Returns the result of `f()`, or of the call already in flight for
+        `key`
+        """
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.stats['coalesced'] += 1
+
+        if leader:
+            try:
+                call.result = f()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def summary(self):
+        return "%(calls)d searches, %(coalesced)d shared with an identical search"%self.stats
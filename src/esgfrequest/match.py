@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+from itertools import islice
+from sqlalchemy import or_, literal, text
+from .model import Checksum, Basename
+
+def chunks(iterable, size):
+    """
+    Returns a generator producing lists of at most `size` items from
+    `iterable`
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+def classify(session, files):
+    """
+    Classify a list of (filename, checksum) pairs against the local database
+
+    Returns a list of (exact, partial) tuples in the same order as `files`.
+    `exact` is 1 if the checksum is known (as either md5 or sha256),
+    `partial` is 1 if only the filename is known (e.g. a different version
+    of the file is held locally).
+
+    Both lookups are done in a single statement for the whole list
+    """
+    if len(files) == 0:
+        return []
+
+    checksums = set(c for f, c in files)
+    names = set(f for f, c in files)
+
+    q = (session
+            .query(literal('checksum'), Checksum.md5, Checksum.sha256)
+            .filter(or_(Checksum.md5.in_(checksums), Checksum.sha256.in_(checksums)))
+            .union_all(session
+                .query(literal('basename'), Basename.basename, Basename.basename)
+                .filter(Basename.basename.in_(names))
+                )
+            )
+
+    known_checksums = set()
+    known_names = set()
+    for kind, a, b in q:
+        if kind == 'checksum':
+            known_checksums.update((a, b))
+        else:
+            known_names.add(a)
+
+    results = []
+    for filename, checksum in files:
+        if checksum in known_checksums:
+            results.append((1, 0))
+        elif filename in known_names:
+            results.append((0, 1))
+        else:
+            results.append((0, 0))
+    return results
+
+def classify_all(session, files, batch_size=250):
+    """
+    Returns a generator classifying an iterable of (filename, checksum) pairs
+    in batches of `batch_size`, see :func:`classify`
+    """
+    for batch in chunks(files, batch_size):
+        for r in classify(session, batch):
+            yield r
+
+def classify_parallel(session_factory, files, batch_size=250, workers=4):
+    """
+    Like :func:`classify_all`, but classifies batches concurrently in
+    `workers` threads
+
+    `session_factory` is called from each worker thread to get a session,
+    so should be a thread-local factory like :data:`esgfrequest.db.Session`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def work(batch):
+        return classify(session_factory(), batch)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch_results in pool.map(work, chunks(files, batch_size)):
+            for r in batch_results:
+                yield r
+
+candidates_table = 'esgfrequest_candidates'
+
+def classify_stream(session, files, batch_size=10000):
+    """
+    Classify a very large iterable of (filename, checksum) pairs
+
+    The pairs are loaded into a temporary table (using COPY on Postgres, or
+    batched inserts of `batch_size` rows elsewhere) then classified with a
+    single join against the checksums and basenames tables, so there is no
+    limit on the number of files that can be checked at once.
+
+    Returns a generator producing (filename, checksum, exact, partial) in the
+    same order as `files`, see :func:`classify`
+    """
+    conn = session.connection()
+    table = _load_candidates(conn, files, batch_size)
+
+    # Separate EXISTS for md5 and sha256 so that each can use an index
+    q = text("""
+        SELECT c.basename, c.checksum,
+            EXISTS (SELECT 1 FROM checksums k WHERE k.ch_md5 = c.checksum)
+                OR EXISTS (SELECT 1 FROM checksums k WHERE k.ch_sha256 = c.checksum),
+            EXISTS (SELECT 1 FROM basenames b WHERE b.basename = c.basename)
+        FROM %s c
+        ORDER BY c.idx
+        """%table).execution_options(stream_results=True)
+
+    result = conn.execute(q)
+    try:
+        for filename, checksum, exact, named in result:
+            if exact:
+                yield (filename, checksum, 1, 0)
+            elif named:
+                yield (filename, checksum, 0, 1)
+            else:
+                yield (filename, checksum, 0, 0)
+    finally:
+        result.close()
+        conn.execute(text('DROP TABLE IF EXISTS %s'%table))
+
+def _load_candidates(conn, files, batch_size):
+    """
+    Load (filename, checksum) pairs into a new temporary table on `conn`
+
+    Returns the table's name
+    """
+    table = candidates_table
+    postgres = conn.dialect.name == 'postgresql'
+    if postgres:
+        # Only ever drop the temporary table, not one found on search_path
+        table = 'pg_temp.' + candidates_table
+
+    conn.execute(text('DROP TABLE IF EXISTS %s'%table))
+    conn.execute(text('CREATE TEMPORARY TABLE %s '
+        '(idx INTEGER PRIMARY KEY, basename TEXT, checksum TEXT)'%candidates_table))
+
+    if postgres:
+        cursor = conn.connection.cursor()
+        cursor.copy_expert('COPY %s (idx, basename, checksum) FROM STDIN'%table,
+                _CopyReader(files))
+        cursor.execute('ANALYZE %s'%table)
+    else:
+        insert = text('INSERT INTO %s (idx, basename, checksum) '
+                'VALUES (:idx, :basename, :checksum)'%table)
+        rows = ({'idx': i, 'basename': f, 'checksum': c}
+                for i, (f, c) in enumerate(files))
+        for batch in chunks(rows, batch_size):
+            conn.execute(insert, batch)
+    return table
+
+class _CopyReader(object):
+    """
+    File-like object producing COPY text format rows from an iterable of
+    (filename, checksum) pairs, so the rows are never all held in memory
+    """
+    def __init__(self, files):
+        self.rows = enumerate(files)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                i, (f, c) = next(self.rows)
+            except StopIteration:
+                break
+            self.buffer += '%d\t%s\t%s\n'%(i, _copy_escape(f), _copy_escape(c))
+
+        if size < 0:
+            size = len(self.buffer)
+        out, self.buffer = self.buffer[:size], self.buffer[size:]
+        return out
+
+def _copy_escape(value):
+    if value is None:
+        return '\\N'
+    return (value
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
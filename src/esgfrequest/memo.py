@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+import six
+from . import logger
+from .match import chunks
+
+# Fields of the file docs kept in a DatasetIndex
+index_fields = ['dataset_id', 'variable', 'title', 'checksum', 'checksum_type',
+        'size', 'url', 'instance_id']
+
+class SearchMemo(object):
+    """
+    In-process memo of the file lists of datasets and of checksum
+    classifications, so that overlapping searches (e.g. `--variable tas pr`
+    then `--variable tas`) don't repeat HTTP requests or database queries
+
+    Use the same memo for each search in a run:
+
+        memo = SearchMemo()
+        search_esgf(args_a, limit, cursor, memo=memo)
+        search_esgf(args_b, limit, cursor, memo=memo)
+
+    If `index` is a :class:`DatasetIndex` file lists of versioned datasets
+    are also kept there, so later runs don't search for them again. If
+    `shared` is a :class:`LRUCache` file lists of versioned datasets are
+    also kept there, for memos of other searches in the same process to use.
+
+    `stats` counts the work done and avoided
+    """
+    def __init__(self, index=None, shared=None):
+        self.index = index
+        self.shared = shared
+        # (facets, dataset_id, variable) -> file docs, variable None means
+        # all files of the dataset
+        self.dataset_files = {}
+        # (filename, checksum) -> (exact, partial)
+        self.classified = {}
+
+        self.stats = {
+                'file_searches': 0,
+                'file_searches_avoided': 0,
+                'datasets_reused': 0,
+                'classify_queries': 0,
+                'classify_queries_avoided': 0,
+                'files_reused': 0,
+                'datasets_indexed': 0,
+                }
+
+    def dataset_files_generator(self, **kwargs):
+        """
+        Memoised version of
+        :func:`esgfrequest.esgf.search_dataset_files_generator`
+
+        File lists are stored for each dataset id and variable, so only
+        variables that haven't been seen before are searched for
+        """
+        from . import esgf
+
+        limit = kwargs.pop('limit', 10)
+        fields = kwargs.pop('fields', None)
+        on_datasets_done = kwargs.pop('on_datasets_done', None)
+        search_url = kwargs.get('search_url', esgf.default_search_url)
+        file_args = {k: kwargs.get(k) for k in esgf.file_facets}
+
+        variables = _flatten(file_args.pop('variable'))
+        if variables is None:
+            wanted = [None]
+        else:
+            wanted = sorted(set(variables))
+            if fields is not None and 'variable' not in fields:
+                fields = list(fields) + ['variable']
+
+        # Other facets that change the file search are part of the key
+        facets = json.dumps([search_url, fields, file_args], sort_keys=True)
+
+        # The index only holds complete file lists (or those of a variable)
+        index = self.index
+        if (fields is None or not set(fields) <= set(index_fields) or
+                file_args['cf_standard_name'] is not None or
+                file_args['variable_long_name'] is not None):
+            index = None
+
+        datasets = esgf.search_datasets_generator(fields='id', limit=limit, **kwargs)
+        for page in chunks(datasets, limit):
+            ids = [d['id'] for d in page]
+
+            missing = [(i, v) for i in ids for v in wanted
+                    if not self._has(facets, i, v)]
+
+            if index is not None and len(missing) > 0:
+                found = index.get(missing)
+                for key, docs in found.items():
+                    self._store((facets,) + key, docs)
+                missing = [k for k in missing if k not in found]
+                self.stats['datasets_indexed'] += len(found)
+
+            # Search for each missing variable in turn, so files that are
+            # already known aren't returned again
+            for v in _unique(v for i, v in missing):
+                self._fetch(facets, [i for i, mv in missing if mv == v], v,
+                        fields=fields, search_url=search_url, index=index,
+                        **file_args)
+            if len(missing) == 0:
+                self.stats['file_searches_avoided'] += 1
+            self.stats['datasets_reused'] += len(set(ids) - set(i for i, v in missing))
+
+            for i in ids:
+                for n, v in enumerate(wanted):
+                    for doc in self._get(facets, i, v):
+                        # A file with several of the wanted variables is
+                        # only produced for the first of them
+                        if not any(w in doc['variable'] for w in wanted[:n]):
+                            yield doc
+
+            if on_datasets_done is not None:
+                on_datasets_done(ids)
+
+    def _fetch(self, facets, ids, variable, index=None, **kwargs):
+        from . import esgf
+
+        self.stats['file_searches'] += 1
+
+        if index is not None:
+            kwargs['fields'] = index_fields
+
+        found = {}
+        totals = {}
+        received = 0
+        for doc in esgf.search_files_generator(dataset_id=ids,
+                variable=variable, totals=totals, **kwargs):
+            found.setdefault(doc['dataset_id'], []).append(doc)
+            received += 1
+
+        # Only lists known to be complete are kept beyond this memo
+        complete = received == totals.get('numFound', 0)
+        if not complete:
+            logger.warning("Received %d of %d files of %d datasets, not storing their file lists"%(
+                received, totals.get('numFound', 0), len(ids)))
+
+        for i in ids:
+            self._store((facets, i, variable), found.get(i, []), complete)
+
+        if index is not None and complete:
+            index.add([((i, variable), found.get(i, [])) for i in ids])
+
+    def _store(self, key, docs, complete=True):
+        self.dataset_files[key] = docs
+        if complete and self.shared is not None and versioned(key[1]):
+            self.shared[key] = docs
+
+    def _lookup(self, key):
+        docs = self.dataset_files.get(key)
+        if docs is None and self.shared is not None:
+            docs = self.shared.get(key)
+            if docs is not None:
+                # Keep it for the rest of this search, even if it's evicted
+                self.dataset_files[key] = docs
+        return docs
+
+    def _has(self, facets, dataset_id, variable):
+        return (self._lookup((facets, dataset_id, variable)) is not None or
+                self._lookup((facets, dataset_id, None)) is not None)
+
+    def _get(self, facets, dataset_id, variable):
+        docs = self._lookup((facets, dataset_id, variable))
+        if docs is None:
+            # Filter the full list of the dataset's files
+            docs = self._lookup((facets, dataset_id, None))
+            return [d for d in docs if variable in d['variable']]
+        return docs
+
+    def classify(self, session, files):
+        """
+        Memoised version of :func:`esgfrequest.match.classify`
+        """
+        from .match import classify
+
+        todo = _unique(f for f in files if f not in self.classified)
+        if len(todo) == 0:
+            self.stats['classify_queries_avoided'] += 1
+        else:
+            self.stats['classify_queries'] += 1
+            self.classified.update(zip(todo, classify(session, todo)))
+        self.stats['files_reused'] += len(files) - len(todo)
+
+        return [self.classified[f] for f in files]
+
+    def summary(self):
+        """
+        Returns a one line description of `stats`
+        """
+        return ("%(file_searches)d file searches (%(file_searches_avoided)d avoided, "
+                "%(datasets_reused)d datasets reused), "
+                "%(classify_queries)d checksum queries (%(classify_queries_avoided)d avoided, "
+                "%(files_reused)d files reused), "
+                "%(datasets_indexed)d dataset file lists from the index")%self.stats
+
+class LRUCache(object):
+    """
+    Mapping holding at most `size` items, dropping the least recently used
+
+    The cache may be shared between threads
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+class DatasetIndex(object):
+    """
+    Persistent store of the file lists of datasets, keyed by dataset id and
+    variable (None for all the dataset's files)
+
+    A versioned dataset never changes once published, so its file list is
+    kept with no expiry. Unversioned dataset ids are never stored.
+
+    The index may be shared between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS dataset_files (
+                dataset_id TEXT,
+                variable TEXT,
+                docs TEXT,
+                PRIMARY KEY (dataset_id, variable)
+            )""")
+        self.conn.commit()
+
+    def get(self, keys):
+        """
+        Look up (dataset_id, variable) `keys`, falling back to the full file
+        list of the dataset for a variable that isn't stored by itself
+
+        Returns a dict of key to file docs for the keys found
+        """
+        stored = {}
+        with self._lock:
+            for batch in chunks(sorted(set(i for i, v in keys)), 500):
+                q = self.conn.execute(
+                        "SELECT dataset_id, variable, docs FROM dataset_files WHERE dataset_id IN (%s)"%
+                        ','.join('?' * len(batch)), batch)
+                for i, v, docs in q:
+                    stored[(i, v or None)] = docs
+
+        found = {}
+        for i, v in keys:
+            if (i, v) in stored:
+                found[(i, v)] = json.loads(stored[(i, v)])
+            elif (i, None) in stored:
+                found[(i, v)] = [d for d in json.loads(stored[(i, None)])
+                        if v in d['variable']]
+        return found
+
+    def add(self, rows):
+        """
+        Store ((dataset_id, variable), docs) rows for versioned datasets
+        """
+        rows = [(i, v or '', json.dumps(docs)) for (i, v), docs in rows
+                if versioned(i)]
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO dataset_files VALUES (?, ?, ?)",
+                    rows)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def versioned(dataset_id):
+    """
+    True if `dataset_id` names a specific version of a dataset
+    """
+    return re.search(r'\.v\d+(\||$)', dataset_id) is not None
+
+def default_dataset_index_path():
+    from .cli import requestdir
+    return os.path.join(requestdir, '.esgfrequest_datasets.db')
+
+def _flatten(value):
+    """
+    Flatten facet values as produced by the command line (lists of lists)
+    into a list of strings, or None if unset
+    """
+    if value is None:
+        return None
+    if isinstance(value, six.string_types):
+        return [value]
+    out = []
+    for v in value:
+        if isinstance(v, six.string_types):
+            out.append(v)
+        else:
+            out.extend(v)
+    return out
+
+def _unique(values):
+    """
+    Remove duplicates from `values`, keeping the first of each
+    """
+    seen = set()
+    out = []
+    for v in values:
+        if v not in seen:
+            seen.add(v)
+            out.append(v)
+    return out
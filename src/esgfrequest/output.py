@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Machine-readable output of search results
+
+Rows are written as each dataset is completed, so that downstream tools can
+start work while a search is still running
+"""
+from __future__ import print_function
+import csv
+import json
+import sys
+
+# Columns of each output row
+columns = ['key', 'dataset_id', 'variable', 'matches', 'partial', 'misses', 'size']
+
+formats = ['jsonl', 'csv', 'parquet']
+
+def open_writer(format, path='-'):
+    """
+    Returns a writer for `format` (one of `formats`) writing to `path`,
+    '-' meaning stdout
+    """
+    if format == 'parquet':
+        if path == '-':
+            raise ValueError("Parquet output needs a file path")
+        return ParquetWriter(path)
+
+    if path == '-':
+        f = sys.stdout
+    else:
+        f = open(path, 'w')
+
+    if format == 'jsonl':
+        return JsonlWriter(f)
+    elif format == 'csv':
+        return CsvWriter(f)
+    raise ValueError("Unknown output format '%s'"%format)
+
+class JsonlWriter(object):
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + '\n')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        if self.f is not sys.stdout:
+            self.f.close()
+
+class CsvWriter(JsonlWriter):
+    def __init__(self, f):
+        super(CsvWriter, self).__init__(f)
+        self.writer = csv.DictWriter(f, fieldnames=columns)
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+class ParquetWriter(object):
+    """
+    Writes rows to a Parquet file in row groups of `row_group_size`
+
+    Needs pyarrow
+    """
+    def __init__(self, path, row_group_size=10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs the 'pyarrow' package")
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema(
+                [(c, pyarrow.string()) for c in columns[:3]] +
+                [(c, pyarrow.int64()) for c in columns[3:]])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def flush(self, force=False):
+        # Only write full row groups, unless closing
+        if len(self.rows) == 0 or (len(self.rows) < self.row_group_size and not force):
+            return
+        table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush(force=True)
+        self.writer.close()
+
+class ResultStream(object):
+    """
+    Writes the rows of a results dict to `writer` once all the files of
+    their dataset have been counted
+
+    Call :meth:`datasets_done` when a search has produced all the files of
+    a list of datasets, and :meth:`batch_done` after each batch of files
+    has been totalled into `results`
+    """
+    def __init__(self, results, writer):
+        self.results = results
+        self.writer = writer
+        # dataset_id -> keys of results for that dataset (as an ordered set)
+        self.keys = {}
+        self.finished = []
+        self.written = set()
+
+    def datasets_done(self, ids):
+        self.finished.extend(ids)
+
+    def batch_done(self, docs, classified=None):
+        from .cli import result_key
+
+        for doc in docs:
+            self.keys.setdefault(doc['dataset_id'], {})[result_key(doc)] = True
+
+        for dataset_id in self.finished:
+            for key in self.keys.pop(dataset_id, {}):
+                self.write(key)
+        self.finished = []
+        self.writer.flush()
+
+    def write(self, key):
+        row = {'key': key}
+        row.update((c, self.results[key][c]) for c in columns[1:])
+        self.writer.write(row)
+        self.written.add(key)
+
+    def close(self):
+        # Anything not yet written, e.g. a dataset cut short by the search
+        # limit
+        for key in self.results:
+            if key not in self.written:
+                self.write(key)
+        self.writer.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Classify and total file docs in worker processes, for very large searches
+where the per-file Python work is the bottleneck
+"""
+from __future__ import print_function
+import multiprocessing
+import zlib
+
+def engine_url(session):
+    """
+    Returns the database URL `session` is connected to, including the
+    password, so that worker processes can make their own connections
+    """
+    url = session.get_bind().url
+    try:
+        return url.render_as_string(hide_password=False)
+    except AttributeError:
+        # SQLAlchemy < 1.4 doesn't hide the password
+        return str(url)
+
+def partition(dataset_id, processes):
+    """
+    Worker process that handles the files of `dataset_id`
+
+    This must be stable between runs, unlike hash()
+    """
+    return zlib.crc32(dataset_id.encode('utf-8')) % processes
+
+def aggregate_processes(docs, db_url, results, processes=4, batch_size=250, chunk_size=1000):
+    """
+    Parallel version of :func:`esgfrequest.cli.aggregate`
+
+    Docs are partitioned between `processes` workers by dataset id, and
+    sent to them in chunks of `chunk_size`. Each worker connects to `db_url`
+    and totals its own datasets, then the partial tables are merged into
+    `results` in the order the keys were first seen, so the output is the
+    same as from the serial path.
+
+    Returns the number of docs processed
+    """
+    ctx = multiprocessing.get_context()
+
+    # Bounded queues, so a slow worker holds back the search rather than
+    # docs piling up in memory
+    tasks = [ctx.Queue(maxsize=4) for _ in range(processes)]
+    done = ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(db_url, q, done, batch_size))
+            for q in tasks]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    try:
+        buckets = [[] for _ in range(processes)]
+        for index, doc in enumerate(docs):
+            p = partition(doc['dataset_id'], processes)
+            buckets[p].append((index, doc))
+            if len(buckets[p]) >= chunk_size:
+                tasks[p].put(buckets[p])
+                buckets[p] = []
+
+        for p in range(processes):
+            if len(buckets[p]) > 0:
+                tasks[p].put(buckets[p])
+            tasks[p].put(None)
+
+        partials = [done.get() for _ in workers]
+    finally:
+        for w in workers:
+            w.join(timeout=1)
+            if w.is_alive():
+                w.terminate()
+
+    failed = [p for p in partials if isinstance(p, Exception)]
+    if len(failed) > 0:
+        raise failed[0]
+
+    # Partitions have no keys in common
+    order = {}
+    merged = {}
+    count = 0
+    for part_results, part_order, part_count in partials:
+        merged.update(part_results)
+        order.update(part_order)
+        count += part_count
+
+    for key in sorted(merged, key=order.get):
+        results[key] = merged[key]
+
+    return count
+
+def _worker(db_url, tasks, done, batch_size):
+    """
+    Total the chunks of (index, doc) pairs from `tasks`, until a None is
+    received, then put (results, first index of each key, count) on `done`
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from .cli import aggregate, result_key
+
+    try:
+        engine = create_engine(db_url)
+        session = sessionmaker(bind=engine)()
+
+        results = {}
+        order = {}
+        count = 0
+        for chunk in iter(tasks.get, None):
+            for index, doc in chunk:
+                order.setdefault(result_key(doc), index)
+            count += aggregate([doc for index, doc in chunk], session, results, batch_size)
+
+        session.close()
+        engine.dispose()
+        done.put((results, order, count))
+    except Exception as e:
+        done.put(e)
+        # Keep reading so the main process doesn't block
+        for chunk in iter(tasks.get, None):
+            pass
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tracking of files that have already been requested
+
+Each file written to a request file is recorded by checksum in a small
+SQLite index, so that later requests can skip files that are already
+waiting to be downloaded
+"""
+from __future__ import print_function
+import argparse
+import os
+import shlex
+import sqlite3
+from .match import chunks
+
+class RequestIndex(object):
+    """
+    Index of pending requested files, keyed by checksum
+
+    Entries whose request file has been removed (e.g. once it has been
+    processed) are dropped by :meth:`prune`
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                checksum TEXT PRIMARY KEY,
+                path TEXT,
+                title TEXT,
+                size INTEGER
+            )""")
+        self.conn.commit()
+
+    def pending(self, checksums):
+        """
+        Returns the set of `checksums` that have already been requested
+        """
+        found = set()
+        for batch in chunks(set(checksums), 500):
+            q = self.conn.execute(
+                    "SELECT checksum FROM requests WHERE checksum IN (%s)"%
+                    ','.join('?' * len(batch)), batch)
+            found.update(r[0] for r in q)
+        return found
+
+    def sizes(self, checksums):
+        """
+        Returns a dict of checksum to file size for the known `checksums`
+        """
+        found = {}
+        for batch in chunks(set(checksums), 500):
+            q = self.conn.execute(
+                    "SELECT checksum, size FROM requests WHERE checksum IN (%s)"%
+                    ','.join('?' * len(batch)), batch)
+            found.update(q)
+        return found
+
+    def add(self, rows):
+        """
+        Record (checksum, request file path, title, size) rows
+        """
+        self.conn.executemany(
+                "INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def move(self, checksums, path):
+        """
+        Record that `checksums` are now requested in the file `path`
+        """
+        self.conn.executemany("UPDATE requests SET path = ? WHERE checksum = ?",
+                [(path, c) for c in checksums])
+        self.conn.commit()
+
+    def remove(self, checksums):
+        """
+        Forget `checksums`, e.g. once they have been downloaded
+        """
+        self.conn.executemany("DELETE FROM requests WHERE checksum = ?",
+                [(c,) for c in checksums])
+        self.conn.commit()
+
+    def prune(self):
+        """
+        Drop entries whose request file no longer exists
+
+        Returns the number of entries dropped
+        """
+        paths = [r[0] for r in self.conn.execute("SELECT DISTINCT path FROM requests")]
+        gone = [(p,) for p in paths if not os.path.exists(p)]
+        before = self.conn.total_changes
+        self.conn.executemany("DELETE FROM requests WHERE path = ?", gone)
+        self.conn.commit()
+        return self.conn.total_changes - before
+
+    def close(self):
+        self.conn.close()
+
+def default_index_path():
+    from .cli import requestdir
+    return os.path.join(requestdir, '.esgfrequest_requests.db')
+
+def read_request(path):
+    """
+    Read a request file
+
+    Returns a list of (fields, line), fields being the values of the line
+    (title, url, checksum_type, checksum, fallback urls...)
+    """
+    out = []
+    with open(path) as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            out.append((shlex.split(line), line if line.endswith('\n') else line + '\n'))
+    return out
+
+def merge(paths, out, index=None, largest_first=True, session=None):
+    """
+    Combine the request files `paths` into `out`, keeping only the first
+    line for each checksum and sorting by file size (from `index`)
+
+    If `session` is given, files already in its checksum database (e.g.
+    downloaded since they were requested) are left out, and removed from
+    `index`. The whole list is checked at once with
+    :func:`esgfrequest.match.classify_stream`.
+
+    Returns the number of lines written
+    """
+    lines = {}
+    titles = {}
+    for p in paths:
+        for fields, line in read_request(p):
+            lines.setdefault(fields[3], line)
+            titles.setdefault(fields[3], fields[0])
+
+    if session is not None:
+        from .match import classify_stream
+        held = [checksum for title, checksum, exact, partial in
+                classify_stream(session, ((titles[c], c) for c in lines)) if exact]
+        for checksum in held:
+            del lines[checksum]
+        if index is not None:
+            index.remove(held)
+
+    sizes = {}
+    if index is not None:
+        sizes = index.sizes(lines)
+
+    # Files of unknown size go last
+    def order(checksum):
+        size = sizes.get(checksum)
+        if size is None:
+            return (1, 0)
+        return (0, -size if largest_first else size)
+
+    with open(out, 'w') as f:
+        for checksum in sorted(lines, key=order):
+            f.write(lines[checksum])
+
+    if index is not None:
+        index.move(lines, out)
+    return len(lines)
+
+def merge_cli():
+    parser = argparse.ArgumentParser(description="""
+    Merge request files into one transfer list, with each file only listed
+    once and the largest files first
+    """)
+    parser.add_argument('output',
+            help="Merged request file to write")
+    parser.add_argument('requests', nargs='+',
+            help="Request files to merge")
+    parser.add_argument('--smallest_first',
+            help="Sort the smallest files first",
+            action='store_true')
+    parser.add_argument('--index',
+            help="Pending request index, for file sizes",
+            default=default_index_path())
+    parser.add_argument('--skip_held',
+            help="Leave out files already in the checksum database",
+            action='store_true')
+    parser.add_argument('--user',
+            help="Username to connect to the database, for --skip_held",
+            default=os.environ.get('USER'))
+    parser.add_argument('--db',
+            help="Check against a local SQLite mirror (from esgfrequest-mirror) instead of MAS")
+    args = parser.parse_args()
+
+    session = None
+    if args.skip_held:
+        import sqlalchemy
+        from .cli import connect_db
+        try:
+            session = connect_db(user=args.user, db=args.db)
+        except (sqlalchemy.exc.OperationalError, IOError) as e:
+            print("\nError connecting to MAS database:")
+            print(e)
+            return -1
+
+    index = RequestIndex(args.index)
+    n = merge(args.requests, args.output, index, largest_first=not args.smallest_first,
+            session=session)
+    index.close()
+    print("Wrote %d files to %s"%(n, args.output))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Estimating how long the missing files of a search will take to download
+
+Missing bytes are totalled by the data node serving each file, then each
+node's throughput gives the number of connections worth opening to it and
+the time its files will take. Nodes are downloaded from in parallel, so the
+whole transfer takes as long as the slowest node (or the local link, if
+that is the bottleneck).
+"""
+from __future__ import print_function
+import math
+from .replicas import http_urls, data_node, measure_speed
+
+# Single connection throughput assumed for nodes that aren't measured,
+# bytes/s
+default_connection_speed = 5e6
+
+class TransferPlanner(object):
+    """
+    Totals the files missing from a search by data node
+
+    Pass :meth:`add_batch` as the `after_batch` callback of
+    :func:`esgfrequest.cli.aggregate`
+    """
+    def __init__(self):
+        # node -> {'files', 'bytes', 'url'}
+        self.nodes = {}
+
+    def add_batch(self, docs, classified):
+        for doc, (exact, partial) in zip(docs, classified):
+            if exact or partial:
+                continue
+            urls = http_urls(doc)
+            if urls:
+                node = data_node(urls[0])
+            else:
+                # Dataset ids end with '|data_node'
+                node = doc['dataset_id'].rsplit('|', 1)[-1]
+            n = self.nodes.setdefault(node, {'files': 0, 'bytes': 0,
+                'url': urls[0] if urls else None})
+            n['files'] += 1
+            n['bytes'] += doc['size']
+
+    def plan(self, speeds=None, measure=False, max_connections=8, link=None):
+        """
+        Estimate the transfer of the missing files
+
+        Args:
+            speeds: Dict of data node hostname to total throughput in bytes/s
+            measure: Measure the single connection speed of each node by
+                downloading part of one of its files
+            max_connections: Most connections to open to a single node
+            link: Throughput of the local network link in bytes/s
+
+        Returns a :class:`TransferPlan`
+        """
+        speeds = speeds or {}
+        nodes = []
+        for node, n in sorted(self.nodes.items()):
+            per_connection = default_connection_speed
+            if measure and n['url'] is not None:
+                per_connection = measure_speed(n['url']) or per_connection
+
+            capacity = speeds.get(node)
+            if capacity is None:
+                connections = max_connections
+            else:
+                connections = int(math.ceil(capacity / per_connection))
+            connections = max(1, min(connections, max_connections, n['files']))
+
+            bandwidth = connections * per_connection
+            if capacity is not None:
+                bandwidth = min(bandwidth, capacity)
+
+            nodes.append({
+                'node': node,
+                'files': n['files'],
+                'bytes': n['bytes'],
+                'bandwidth': bandwidth,
+                'connections': connections,
+                'seconds': n['bytes'] / bandwidth,
+                })
+        return TransferPlan(nodes, link)
+
+class TransferPlan(object):
+    """
+    Estimated transfer of the missing files from each data node
+
+    Attributes:
+        nodes: List of dicts with the node, files, bytes, bandwidth (bytes/s),
+            connections and seconds to transfer for each data node
+        link: Throughput of the local network link in bytes/s, or None
+    """
+    def __init__(self, nodes, link=None):
+        self.nodes = nodes
+        self.link = link
+
+    @property
+    def bytes(self):
+        return sum(n['bytes'] for n in self.nodes)
+
+    @property
+    def seconds(self):
+        """
+        Time for the whole transfer, downloading from all nodes at once
+        """
+        t = max([n['seconds'] for n in self.nodes] or [0])
+        if self.link:
+            t = max(t, self.bytes / self.link)
+        return t
+
+    def fits(self, window):
+        """
+        True if the transfer should finish within `window` seconds
+        """
+        return self.seconds <= window
+
+def duration_str(seconds):
+    """
+    Format `seconds` as hours and minutes
+    """
+    minutes = int(math.ceil(seconds / 60.0))
+    return "%3dh%02dm"%(minutes // 60, minutes % 60)
+
+def print_plan(plan, window=None):
+    from .cli import size_str
+
+    print("\nnode\t\t\t\tfiles\t     size\t  MB/s\tconns\t    time")
+    for n in sorted(plan.nodes, key=lambda n: -n['seconds']):
+        print("%-30s\t%5d\t%s\t%6.1f\t%5d\t%s"%(n['node'], n['files'],
+            size_str(n['bytes']), n['bandwidth'] / 1e6, n['connections'],
+            duration_str(n['seconds'])))
+
+    print("\nEstimated transfer time: %s for %s"%(
+        duration_str(plan.seconds).strip(), size_str(plan.bytes).strip()))
+    if window is not None:
+        if plan.fits(window):
+            print("Fits in the %s window"%duration_str(window).strip())
+        else:
+            print("Does NOT fit in the %s window"%duration_str(window).strip())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Choosing which data node to download a file from
+
+Every replica of a file is found by searching on its instance id, then the
+HTTP URLs are ranked by the throughput of their data node, either
+configured or measured by downloading a small part of a file
+"""
+from __future__ import print_function
+import json
+import threading
+import time
+from six.moves.urllib.parse import urlparse
+from .match import chunks
+
+def http_urls(doc):
+    """
+    HTTP download URLs of the file `doc`
+    """
+    return [u[0] for u in [u.split('|') for u in doc.get('url', [])] if u[2] == 'HTTPServer']
+
+def data_node(url):
+    """
+    Hostname of the data node serving `url`
+    """
+    return urlparse(url).hostname
+
+def load_speeds(path):
+    """
+    Read data node throughputs from a JSON file of {hostname: MB/s}
+
+    Returns a dict of hostname to bytes/s
+    """
+    with open(path) as f:
+        return {k: float(v) * 1e6 for k, v in json.load(f).items()}
+
+def measure_speed(url, nbytes=1024*1024, timeout=30):
+    """
+    Measure the throughput of the data node serving `url` in bytes/s, by
+    downloading the first `nbytes` of the file
+
+    Returns 0 if the download fails
+    """
+    from .esgf import http_session
+
+    start = time.time()
+    received = 0
+    try:
+        r = http_session().get(url, headers={'Range': 'bytes=0-%d'%(nbytes - 1)},
+                stream=True, timeout=timeout)
+        r.raise_for_status()
+        for chunk in r.iter_content(64*1024):
+            received += len(chunk)
+            if received >= nbytes:
+                break
+        r.close()
+    except Exception:
+        return 0.0
+    return received / max(time.time() - start, 1e-6)
+
+class NodeRanking(object):
+    """
+    Ranks download URLs by the throughput of their data node
+
+    Args:
+        speeds: Dict of data node hostname to bytes/s
+        measure: Measure the speed of nodes not in `speeds` (once each)
+
+    Nodes with no known speed rank below those with one, keeping their
+    original order
+    """
+    def __init__(self, speeds=None, measure=False):
+        self.speeds = dict(speeds or {})
+        self.measure = measure
+        self._lock = threading.Lock()
+
+    def speed(self, url):
+        node = data_node(url)
+        if node not in self.speeds and self.measure:
+            s = measure_speed(url)
+            with self._lock:
+                self.speeds.setdefault(node, s)
+        return self.speeds.get(node)
+
+    def rank(self, urls):
+        return sorted(urls, key=lambda u: -(self.speed(u) or 0))
+
+def find_replicas(docs, search_url=None, batch_size=50):
+    """
+    Search for every copy of the files `docs`, original or replica
+
+    Returns a dict of instance_id to HTTP URLs
+    """
+    from . import esgf
+
+    if search_url is None:
+        search_url = esgf.default_search_url
+
+    ids = sorted(set(d['instance_id'] for d in docs))
+    urls = {}
+    for batch in chunks(ids, batch_size):
+        for doc in esgf.search_files_generator(instance_id=batch,
+                fields=['instance_id', 'url'], search_url=search_url,
+                replica=None, latest=None, distrib=True, quiet=True):
+            found = urls.setdefault(doc['instance_id'], [])
+            found.extend(u for u in http_urls(doc) if u not in found)
+    return urls
+
+def select_urls(docs, ranking, search_url=None, fallbacks=2):
+    """
+    Choose download URLs for each of `docs` from all the replicas of the
+    file
+
+    Returns a list with the best URL followed by up to `fallbacks` others
+    for each doc
+    """
+    replicas = find_replicas(docs, search_url)
+    out = []
+    for d in docs:
+        urls = http_urls(d)
+        urls += [u for u in replicas.get(d['instance_id'], []) if u not in urls]
+        out.append(ranking.rank(urls)[:1 + fallbacks])
+    return out
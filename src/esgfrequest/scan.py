@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Building a local checksum database by scanning the filesystem, for sites
+without access to MAS
+
+    esgfrequest-scan ~/local.db /g/data/cmip5
+    esgfrequest --db ~/local.db --model ACCESS1.0
+
+Directories are listed and files hashed by thread pools. The size and mtime
+of each file is recorded, so a rescan only hashes new or changed files and
+drops files that have been removed.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+from sqlalchemy import MetaData, Table, Column, Text, Integer, Float
+from .match import chunks
+
+metadata = MetaData()
+
+# Files the checksums and basenames tables were filled from
+scanned = Table('scanned_files', metadata,
+        Column('path', Text, primary_key=True),
+        Column('size', Integer),
+        Column('mtime', Float),
+        Column('hash', Text),
+        )
+
+suffixes = ('.nc', '.nc4')
+
+def find_files(root, suffixes=suffixes, workers=8):
+    """
+    Find files under `root` ending with one of `suffixes`, listing
+    directories with `workers` threads
+
+    Returns a generator producing (path, size, mtime) for each file
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def listdir(d):
+        files, dirs = [], []
+        try:
+            entries = list(os.scandir(d))
+        except OSError:
+            return files, dirs
+        for e in entries:
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    dirs.append(e.path)
+                elif e.name.endswith(suffixes) and e.is_file():
+                    st = e.stat()
+                    files.append((e.path, st.st_size, st.st_mtime))
+            except OSError:
+                pass
+        return files, dirs
+
+    todo = [root]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while todo:
+            listings = list(pool.map(listdir, todo))
+            todo = []
+            for files, dirs in listings:
+                for f in files:
+                    yield f
+                todo.extend(dirs)
+
+def scan(session, root, types=('md5', 'sha256'), workers=4, batch_size=1000):
+    """
+    Update the checksum database of `session` with the files under `root`
+
+    Returns a dict with the number of files added (new or changed), removed
+    and unchanged
+    """
+    from .db import add_files
+    from .model import Checksum, Basename
+    from .verify import digests
+
+    metadata.create_all(session.get_bind())
+
+    root = os.path.abspath(root)
+    prefix = os.path.join(root, '')
+    q = scanned.select().where(scanned.c.path.startswith(prefix, autoescape=True))
+    known = {path: (size, mtime, id) for path, size, mtime, id in session.execute(q)}
+
+    found = {}
+    for path, size, mtime in find_files(root):
+        found[path] = (size, mtime)
+
+    changed = [p for p in found if known.get(p, (None, None))[:2] != found[p]]
+    stale = [p for p in known if known[p][:2] != found.get(p)]
+
+    for batch in chunks(stale, batch_size):
+        hashes = [known[p][2] for p in batch]
+        session.query(Checksum).filter(Checksum.id.in_(hashes)).delete(synchronize_session=False)
+        session.query(Basename).filter(Basename.id.in_(hashes)).delete(synchronize_session=False)
+        session.execute(scanned.delete().where(scanned.c.path.in_(batch)))
+    session.commit()
+
+    added = 0
+    for batch in chunks(digests(changed, types, workers), batch_size):
+        batch = [(p, d) for p, d in batch if d is not None]
+        ids = add_files(session, [(os.path.basename(p), d.get('md5'), d.get('sha256'))
+            for p, d in batch])
+        if batch:
+            session.execute(scanned.insert(), [
+                {'path': p, 'size': found[p][0], 'mtime': found[p][1], 'hash': id}
+                for (p, d), id in zip(batch, ids)])
+        session.commit()
+        added += len(batch)
+
+    return {
+            'added': added,
+            'removed': len([p for p in known if p not in found]),
+            'unchanged': len(found) - len(changed),
+            }
+
+def cli():
+    parser = argparse.ArgumentParser(description="""
+    Add the netCDF files under data directories to a local SQLite checksum
+    database, which can then be used for matching with 'esgfrequest --db'.
+    Only new or changed files are checksummed when run again.
+    """)
+    parser.add_argument('db',
+            help="SQLite checksum database to update")
+    parser.add_argument('roots', nargs='+',
+            help="Data directories to scan")
+    parser.add_argument('--workers',
+            help="Number of files to checksum at once",
+            type=int,
+            default=4)
+    parser.add_argument('--checksums',
+            help="Checksum types to compute",
+            nargs='+',
+            choices=['md5', 'sha256'],
+            default=['md5', 'sha256'])
+    args = parser.parse_args()
+
+    from .db import connect, match_indexes, Session
+    engine = connect('sqlite:///%s'%args.db, init=True)
+    for index in match_indexes():
+        index.create(engine, checkfirst=True)
+    session = Session()
+
+    for root in args.roots:
+        counts = scan(session, root, args.checksums, args.workers)
+        print("%s: %d added, %d removed, %d unchanged"%(root,
+            counts['added'], counts['removed'], counts['unchanged']), file=sys.stderr)
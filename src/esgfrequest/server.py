@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A long running search service with a local HTTP/JSON API
+
+The database connection pool, HTTP session, dataset index and the file
+lists of recently seen versioned datasets stay warm between queries, and
+complete answers are cached for a few minutes, so repeated queries are
+answered without any searching at all. Files are classified again for each
+query (unless its answer is cached), so files downloaded or scanned since
+are found.
+
+    esgfrequest-serve --port 8765
+
+    curl 'http://localhost:8765/search?model=ACCESS1.0&variable=tas'
+    curl -d '{"model": ["ACCESS1.0"], "latest": "all"}' http://localhost:8765/search
+    curl http://localhost:8765/stats
+    curl 'http://localhost:8765/coverage?dataset_id=...'
+
+Queries use the same JSON form as esgfrequest-batch, as a POST body or as
+URL parameters (with multiple values separated by commas), plus an optional
+'limit' on the number of files. Coverage is looked up in the table kept
+by esgfrequest-coverage.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse, parse_qs
+from . import logger
+
+class ResponseCache(object):
+    """
+    Keeps up to `size` answers for `ttl` seconds
+    """
+    def __init__(self, ttl=300, size=1000):
+        self.ttl = ttl
+        self.size = size
+        # Entries in order of expiry, as they all have the same ttl
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.entries.pop(key, None)
+                return None
+            return entry[1]
+
+    def add(self, key, value):
+        now = time.time()
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.ttl, value)
+            # Drop expired answers, and the oldest if there are too many
+            while len(self.entries) > 0:
+                expires, oldest = next(iter(self.entries.values()))
+                if expires >= now and len(self.entries) <= self.size:
+                    break
+                self.entries.popitem(last=False)
+
+class QueryService(object):
+    """
+    Answers search queries, sharing state between them
+
+    Each query gets its own :class:`esgfrequest.memo.SearchMemo`, sharing
+    the file lists of versioned datasets (which don't change) through an
+    LRU cache
+
+    Args:
+        session: A scoped session (e.g. :data:`esgfrequest.db.Session`), so
+            each request thread has its own connection from the pool
+        index: :class:`esgfrequest.memo.DatasetIndex` used by all queries
+        limit: Default maximum number of files per query
+        ttl: Seconds to cache answers for
+        coverage: :class:`esgfrequest.coverage.CoverageStore` for coverage
+            lookups
+        datasets: Most dataset file lists to keep in memory
+        answers: Most answers to cache
+    """
+    def __init__(self, session, index=None, limit=1000, ttl=300, coverage=None,
+            datasets=10000, answers=1000):
+        from .memo import LRUCache
+
+        self.session = session
+        self.index = index
+        self.coverage = coverage
+        self.limit = limit
+        self.dataset_files = LRUCache(datasets)
+        self.cache = ResponseCache(ttl, answers)
+        self.stats = {'queries': 0, 'cached': 0}
+        self.memo_stats = {}
+        self._lock = threading.Lock()
+
+    def search(self, query):
+        """
+        Run a JSON query (see :func:`esgfrequest.batch.parse_query`), with
+        an optional 'limit'
+
+        Returns a dict with the file count, a summary and the rows of the
+        results
+        """
+        from .batch import parse_query
+        from .cli import search_esgf
+        from .memo import SearchMemo
+        from .table import ResultTable
+
+        query = dict(query)
+        limit = int(query.pop('limit', self.limit))
+        key = json.dumps([query, limit], sort_keys=True)
+
+        with self._lock:
+            self.stats['queries'] += 1
+        answer = self.cache.get(key)
+        if answer is not None:
+            with self._lock:
+                self.stats['cached'] += 1
+            return answer
+
+        args = parse_query(query)
+        memo = SearchMemo(index=self.index, shared=self.dataset_files)
+        try:
+            results, count = search_esgf(args, limit, self.session(), memo=memo)
+        finally:
+            self.session.remove()
+
+        with self._lock:
+            for k, v in memo.stats.items():
+                self.memo_stats[k] = self.memo_stats.get(k, 0) + v
+
+        table = ResultTable.from_results(results)
+        answer = {
+                'count': count,
+                'limit_reached': count == limit,
+                'summary': table.summary(),
+                'results': [dict(row, key=k) for k, row in table.rows()],
+                }
+        self.cache.add(key, answer)
+        return answer
+
+    def lookup_coverage(self, dataset_ids):
+        """
+        Returns the stored coverage rows of `dataset_ids`
+        """
+        if self.coverage is None:
+            raise ValueError("No coverage table")
+        return {'results': self.coverage.get(dataset_ids)}
+
+    def status(self):
+        from .esgf import single_flight
+        with self._lock:
+            stats = dict(self.stats)
+            memo_stats = dict(self.memo_stats)
+        stats['datasets_cached'] = len(self.dataset_files)
+        return {
+                'service': stats,
+                'memo': memo_stats,
+                'searches': dict(single_flight.stats),
+                }
+
+def query_from_params(params):
+    """
+    Convert URL parameters (from :func:`parse_qs`) to a JSON query
+    """
+    query = {}
+    for key, values in params.items():
+        values = [v for value in values for v in value.split(',')]
+        query[key] = values[0] if len(values) == 1 else values
+    return query
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def make_server(service, host='127.0.0.1', port=8765):
+    """
+    Returns an HTTP server answering queries with `service`, call
+    `serve_forever()` to run it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/search':
+                self.answer(lambda: service.search(query_from_params(parse_qs(url.query))))
+            elif url.path == '/coverage':
+                ids = query_from_params(parse_qs(url.query)).get('dataset_id', [])
+                if not isinstance(ids, list):
+                    ids = [ids]
+                self.answer(lambda: service.lookup_coverage(ids))
+            elif url.path == '/stats':
+                self.answer(service.status)
+            else:
+                self.reply(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/search':
+                return self.reply(404, {'error': 'Not found'})
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                query = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as e:
+                return self.reply(400, {'error': 'Invalid JSON: %s'%e})
+            self.answer(lambda: service.search(query))
+
+        def answer(self, f):
+            try:
+                self.reply(200, f())
+            except ValueError as e:
+                self.reply(400, {'error': str(e)})
+            except Exception as e:
+                logger.exception("Query failed")
+                self.reply(500, {'error': str(e)})
+
+        def reply(self, status, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.info(format%args)
+
+    return _ThreadingHTTPServer((host, port), Handler)
+
+def cli():
+    from .coverage import CoverageStore, default_coverage_path
+
+    parser = argparse.ArgumentParser(description="""
+    Answer esgfrequest searches over a local HTTP/JSON API, keeping
+    connections and caches warm between queries
+    """)
+    parser.add_argument('--host',
+            help="Address to listen on",
+            default='127.0.0.1')
+    parser.add_argument('--port',
+            help="Port to listen on",
+            type=int,
+            default=8765)
+    parser.add_argument('--user',
+            help="Username to connect to the database",
+            default=os.environ['USER'])
+    parser.add_argument('--db',
+            help="Match against a local SQLite mirror (from esgfrequest-mirror) instead of MAS")
+    parser.add_argument('--pool_size',
+            help="Number of database connections to keep open",
+            type=int)
+    parser.add_argument('--limit',
+            help="Default maximum number of files to search for each query",
+            type=int,
+            default=1000)
+    parser.add_argument('--ttl',
+            help="Seconds to cache answers for",
+            type=int,
+            default=300)
+    parser.add_argument('--rate',
+            help="Most search requests per second to each index node",
+            type=float,
+            default=20)
+    parser.add_argument('--max_datasets',
+            help="Most dataset file lists to keep in memory",
+            type=int,
+            default=10000)
+    parser.add_argument('--max_answers',
+            help="Most answers to cache",
+            type=int,
+            default=1000)
+    parser.add_argument('--no_dataset_index',
+            help="Don't use or update the stored file lists of versioned datasets",
+            action='store_true')
+    parser.add_argument('--coverage',
+            help="Coverage table from esgfrequest-coverage",
+            default=default_coverage_path())
+    args = parser.parse_args()
+
+    import sqlalchemy
+    from . import throttle
+    from .cli import connect_db
+    from .db import Session
+    from .memo import DatasetIndex, default_dataset_index_path
+
+    throttle.set_rate(args.rate)
+
+    try:
+        connect_db(user=args.user, db=args.db, pool_size=args.pool_size)
+    except (sqlalchemy.exc.OperationalError, IOError) as e:
+        print("\nError connecting to MAS database:")
+        print(e)
+        return -1
+
+    dataset_index = None
+    if not args.no_dataset_index:
+        dataset_index = DatasetIndex(default_dataset_index_path())
+    service = QueryService(Session, dataset_index, args.limit, args.ttl,
+            coverage=CoverageStore(args.coverage), datasets=args.max_datasets,
+            answers=args.max_answers)
+
+    server = make_server(service, args.host, args.port)
+    print("Listening on http://%s:%d/"%server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
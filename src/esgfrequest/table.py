@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import numpy
+import six
+
+class ResultTable(object):
+    """
+    Columnar form of the results from :func:`esgfrequest.cli.search_esgf`
+
+    Each dataset/variable is a row, with the counts in NumPy arrays so that
+    summaries, sorting and filtering are single vectorised passes
+
+    Attributes:
+        key, dataset_id, variable: String columns (object arrays)
+        matches, partial, misses, size: Integer columns
+    """
+    string_columns = ['key', 'dataset_id', 'variable']
+    count_columns = ['matches', 'partial', 'misses', 'size']
+
+    def __init__(self, **columns):
+        for c in self.string_columns:
+            setattr(self, c, numpy.asarray(columns[c], dtype=object))
+        for c in self.count_columns:
+            setattr(self, c, numpy.asarray(columns[c], dtype=numpy.int64))
+
+    @classmethod
+    def from_results(cls, results):
+        """
+        Convert a results dict from :func:`esgfrequest.cli.search_esgf`
+        """
+        rows = [(v['dataset_id'], v['variable'],
+            v['matches'], v['partial'], v['misses'], v['size'])
+            for v in six.itervalues(results)]
+        counts = numpy.array([r[2:] for r in rows], dtype=numpy.int64).reshape(-1, 4)
+
+        return cls(
+                key=list(results),
+                dataset_id=[r[0] for r in rows],
+                variable=[r[1] for r in rows],
+                matches=counts[:, 0], partial=counts[:, 1],
+                misses=counts[:, 2], size=counts[:, 3])
+
+    def to_results(self):
+        """
+        Convert back to a results dict
+        """
+        return {k: v for k, v in self.rows()}
+
+    def __len__(self):
+        return len(self.key)
+
+    def rows(self):
+        """
+        Returns a generator producing (key, row dict) for each row
+        """
+        columns = [(c, getattr(self, c)) for c in self.string_columns[1:]]
+        columns += [(c, getattr(self, c).tolist()) for c in self.count_columns]
+        for i, k in enumerate(self.key):
+            yield k, {c: v[i] for c, v in columns}
+
+    def take(self, index):
+        """
+        Returns a new table with the rows selected by `index`, an integer
+        index array or boolean mask
+        """
+        return ResultTable(**{c: getattr(self, c)[index]
+            for c in self.string_columns + self.count_columns})
+
+    def sort(self, column, reverse=False):
+        """
+        Returns a new table sorted by `column` (stable)
+        """
+        order = numpy.argsort(getattr(self, column), kind='stable')
+        if reverse:
+            order = order[::-1]
+        return self.take(order)
+
+    def summary(self):
+        """
+        Returns totals of partial and missing files, and the size of the
+        datasets containing them
+        """
+        has_misses = self.misses > 0
+        has_partial = self.partial > 0
+        return {
+                'total_misses': int(self.misses.sum()),
+                'missing_size': int(self.size[has_misses].sum()),
+                'total_partial': int(self.partial.sum()),
+                'partial_size': int(self.size[has_partial].sum()),
+                }
+
+    def downloads(self, column):
+        """
+        Returns (dataset_id, variable) of the rows where `column` is non-zero,
+        e.g. the datasets with missing files for `column='misses'`
+        """
+        mask = getattr(self, column) > 0
+        return list(zip(self.dataset_id[mask].tolist(), self.variable[mask].tolist()))
+
+def as_table(results):
+    """
+    Returns `results` as a :class:`ResultTable`, converting a results dict
+    """
+    if isinstance(results, ResultTable):
+        return results
+    return ResultTable.from_results(results)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Keeping the load on each index node within what it will accept
+
+Each host gets a token bucket limiting the request rate, and an adaptive
+limit on the number of requests in flight. The concurrency limit grows by
+one request per round of successful requests and halves when the node
+answers 429 or 503, or when requests take much longer than the fastest
+recent request of the same kind (additive increase, multiplicative
+decrease), so searches run as fast as the node allows without hand tuning.
+"""
+from __future__ import print_function
+import threading
+import time
+from six.moves.urllib.parse import urlparse
+
+# Defaults for new hosts, see set_rate()
+default_rate = 20.0
+default_burst = 40
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls to :meth:`acquire` per second on average, and
+    bursts of up to `burst` calls
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for a token
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Take the token now, waiting for it to be refilled if needed
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class AdaptiveLimit(object):
+    """
+    Limit on the number of concurrent requests, adjusted by AIMD
+
+    Args:
+        initial: Starting limit
+        minimum, maximum: Bounds of the limit
+        tolerance: Latency above this multiple of the baseline latency (the
+            fastest recent request of the same kind) counts as a sign of
+            overload
+        backoff: Factor the limit is multiplied by on overload
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, tolerance=3.0, backoff=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        # Kind of request -> baseline latency, as a facet count is much
+        # quicker than a page of 10000 files
+        self.baselines = {}
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'throttled': 0, 'slow': 0}
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False, kind=None):
+        """
+        Finish a request that took `latency` seconds (None if it failed
+        without a response), `throttled` if the server refused it as
+        overloaded
+
+        `kind` is any hashable describing the size of the request, its
+        latency is only compared with requests of the same kind
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self.stats['requests'] += 1
+
+            if throttled:
+                self.stats['throttled'] += 1
+                self._decrease()
+            elif latency is not None:
+                # Let the baseline drift up slowly, in case the node has
+                # become slower for everyone
+                baseline = self.baselines.get(kind)
+                if baseline is None:
+                    baseline = latency
+                else:
+                    baseline = min(latency, baseline * 1.05)
+                self.baselines[kind] = baseline
+
+                if latency > self.tolerance * baseline:
+                    self.stats['slow'] += 1
+                    self._decrease()
+                else:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+            self._cond.notify_all()
+
+    def _decrease(self):
+        self.limit = max(self.minimum, self.limit * self.backoff)
+
+class Throttle(object):
+    """
+    Rate and concurrency limits for one host
+    """
+    def __init__(self, rate=default_rate, burst=default_burst, **limit_args):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveLimit(**limit_args)
+
+    def request(self, f, kind=None):
+        """
+        Call `f`, which makes a request of `kind` (see
+        :meth:`AdaptiveLimit.release`) and returns a response with a
+        `status_code`, within the limits
+
+        Returns the response
+        """
+        self.concurrency.acquire()
+        start = None
+        throttled = False
+        try:
+            self.bucket.acquire()
+            start = time.time()
+            r = f()
+            throttled = r.status_code in (429, 503)
+            return r
+        except Exception:
+            start = None
+            raise
+        finally:
+            latency = time.time() - start if start is not None else None
+            self.concurrency.release(latency, throttled, kind)
+
+_throttles = {}
+_lock = threading.Lock()
+
+def for_url(url):
+    """
+    Returns the :class:`Throttle` of the host serving `url`
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _throttles:
+            _throttles[host] = Throttle(default_rate, default_burst)
+        return _throttles[host]
+
+def configure(url, **kwargs):
+    """
+    Replace the throttle of the host serving `url` with one made with
+    `kwargs` (see :class:`Throttle`)
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        _throttles[host] = Throttle(**kwargs)
+        return _throttles[host]
+
+def set_rate(rate, burst=None):
+    """
+    Set the request rate (per second) allowed to each index node without its
+    own :func:`configure`, and the burst size (default twice the rate)
+    """
+    global default_rate, default_burst
+    if burst is None:
+        burst = 2 * rate
+    with _lock:
+        default_rate = float(rate)
+        default_burst = burst
+
+def retry_delay(response, attempt, maximum=60):
+    """
+    Seconds to wait before retrying a throttled request, from its
+    Retry-After header or else exponential backoff
+    """
+    try:
+        return min(maximum, float(response.headers['Retry-After']))
+    except (KeyError, ValueError):
+        return min(maximum, 2 ** attempt)
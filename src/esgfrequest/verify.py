@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Checking local files against their ESGF checksums
+
+Files are hashed by a pool of threads reading through a memory map (hashlib
+releases the GIL while hashing, so this scales with the number of threads).
+Digests are cached by (path, size, mtime) in a small SQLite database, so
+files that haven't changed aren't read again.
+
+    esgfrequest-verify --root /g/data/downloads ~/request_*.txt
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+import threading
+from .match import chunks
+from .pending import read_request
+
+block_size = 16*1024*1024
+
+def file_digests(path, types=('sha256',)):
+    """
+    Hash the file `path` with each of the hashlib algorithms `types`, in a
+    single pass
+
+    Returns a dict of type to hex digest
+    """
+    hashes = {t: hashlib.new(t) for t in types}
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(m)
+                for start in range(0, len(m), block_size):
+                    block = view[start:start + block_size]
+                    for h in hashes.values():
+                        h.update(block)
+                    block.release()
+                view.release()
+            finally:
+                m.close()
+    return {t: h.hexdigest() for t, h in hashes.items()}
+
+class DigestCache(object):
+    """
+    Cache of file digests, valid while the file's size and mtime are
+    unchanged
+
+    The cache may be shared between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT,
+                type TEXT,
+                size INTEGER,
+                mtime REAL,
+                digest TEXT,
+                PRIMARY KEY (path, type)
+            )""")
+        self.conn.commit()
+
+    def get(self, files):
+        """
+        Look up the digests of `files`, a list of (path, type, size, mtime)
+
+        Returns a dict of (path, type) to digest for the files with a valid
+        cache entry
+        """
+        found = {}
+        with self._lock:
+            for batch in chunks(sorted(set(p for p, t, s, m in files)), 500):
+                q = self.conn.execute(
+                        "SELECT path, type, size, mtime, digest FROM digests WHERE path IN (%s)"%
+                        ','.join('?' * len(batch)), batch)
+                for path, type, size, mtime, digest in q:
+                    found[(path, type, size, mtime)] = digest
+        return {(p, t): found[(p, t, s, m)] for p, t, s, m in files
+                if (p, t, s, m) in found}
+
+    def add(self, rows):
+        """
+        Record (path, type, size, mtime, digest) rows
+        """
+        with self._lock:
+            self.conn.executemany(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def default_cache_path():
+    from .cli import requestdir
+    return os.path.join(requestdir, '.esgfrequest_digests.db')
+
+def digests(paths, types=('sha256',), workers=4, cache=None):
+    """
+    Hash each of `paths` with the hashlib algorithms `types`, using
+    `workers` threads and skipping files with a valid entry in the
+    :class:`DigestCache` `cache`
+
+    Returns a generator producing (path, {type: digest}) as each file
+    finishes (cached files first), or (path, None) if the file can't be read
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    stats = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stats[p] = (st.st_size, st.st_mtime)
+        except OSError:
+            yield p, None
+
+    todo = list(stats)
+    if cache is not None:
+        cached = cache.get([(p, t) + stats[p] for p in stats for t in types])
+        todo = []
+        for p in stats:
+            if all((p, t) in cached for t in types):
+                yield p, {t: cached[(p, t)] for t in types}
+            else:
+                todo.append(p)
+
+    def work(p):
+        try:
+            return p, file_digests(p, types)
+        except (IOError, OSError):
+            return p, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(work, p) for p in todo]
+        for f in as_completed(futures):
+            p, d = f.result()
+            if d is not None and cache is not None:
+                cache.add([(p, t) + stats[p] + (v,) for t, v in d.items()])
+            yield p, d
+
+def verify(files, workers=4, cache=None):
+    """
+    Check `files`, a list of (path, checksum_type, checksum), against their
+    checksums
+
+    Returns a generator producing (path, ok) for each file, ok being None if
+    the file couldn't be read
+    """
+    expected = {}
+    for path, checksum_type, checksum in files:
+        expected.setdefault(path, {})[checksum_type.lower()] = checksum.lower()
+    types = sorted(set(t for e in expected.values() for t in e))
+
+    for t in types:
+        paths = [p for p in expected if t in expected[p]]
+        for p, d in digests(paths, (t,), workers, cache):
+            if d is None:
+                yield p, None
+            else:
+                yield p, d[t] == expected[p][t]
+
+def cli():
+    parser = argparse.ArgumentParser(description="""
+    Check that the files listed in request files match their ESGF checksums
+    """)
+    parser.add_argument('requests', nargs='+',
+            help="Request files listing the files to check")
+    parser.add_argument('--root',
+            help="Directory holding the files (default current directory)",
+            default='.')
+    parser.add_argument('--workers',
+            help="Number of files to hash at once",
+            type=int,
+            default=4)
+    parser.add_argument('--cache',
+            help="Cache of file digests",
+            default=default_cache_path())
+    args = parser.parse_args()
+
+    files = []
+    for p in args.requests:
+        for fields, line in read_request(p):
+            files.append((os.path.join(args.root, fields[0]), fields[2], fields[3]))
+
+    cache = DigestCache(args.cache)
+    bad = 0
+    missing = 0
+    for path, ok in verify(files, args.workers, cache):
+        if ok is None:
+            print("Missing %s"%path)
+            missing += 1
+        elif not ok:
+            print("Mismatch %s"%path)
+            bad += 1
+    cache.close()
+
+    print("Checked %d files, %d mismatched, %d missing"%(len(files), bad, missing),
+            file=sys.stderr)
+    return 1 if bad or missing else 0
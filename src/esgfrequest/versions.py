@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Finding which version of a dataset is held locally, and which is latest
+
+Partially matched datasets (files known by name but not by checksum) are
+usually an older version held locally. Every version of many datasets is
+found with a few searches on their master ids, then the files of each
+version are classified to find the version that is held.
+"""
+from __future__ import print_function
+import re
+from .match import chunks
+
+def master_id(dataset_id):
+    """
+    Master id of the dataset `dataset_id` (its instance id without the
+    version or data node)
+    """
+    return re.sub(r'\.v\d+$', '', dataset_id.split('|')[0])
+
+def version_key(version):
+    """
+    Sort key of a dataset version, numeric where possible (CMIP5 has short
+    versions like '2' and '10' as well as dates)
+    """
+    try:
+        return (0, int(version.lstrip('v')), version)
+    except ValueError:
+        return (1, 0, version)
+
+def dataset_versions(master_ids, search_url=None, batch_size=50):
+    """
+    Find every version of the datasets `master_ids`
+
+    Returns a dict of master id to a dict of version to a dataset id of
+    that version, and the latest version (as a string) of each master id
+    """
+    from . import esgf
+
+    if search_url is None:
+        search_url = esgf.default_search_url
+
+    versions = {}
+    latest = {}
+    for batch in chunks(sorted(set(master_ids)), batch_size):
+        for doc in esgf.search_datasets_generator(master_id=batch, latest=None,
+                replica=None, fields=['id', 'master_id', 'version', 'latest'],
+                search_url=search_url, limit=1000):
+            version = str(doc['version'])
+            versions.setdefault(doc['master_id'], {}).setdefault(version, doc['id'])
+            if doc.get('latest'):
+                latest[doc['master_id']] = version
+    return versions, latest
+
+def local_versions(session, versions, search_url=None, batch_size=50):
+    """
+    Find the newest version of each dataset in `versions` (from
+    :func:`dataset_versions`) with files in the checksum database of
+    `session`
+
+    Returns a dict of master id to (version, files matched, files in the
+    version), leaving out datasets with no version held
+    """
+    from . import esgf
+    from .match import classify
+
+    if search_url is None:
+        search_url = esgf.default_search_url
+
+    ids = {}
+    for m, vs in versions.items():
+        for v, dataset_id in vs.items():
+            ids[dataset_id] = (m, v)
+
+    counts = {}
+    for batch in chunks(sorted(ids), batch_size):
+        for docs in chunks(esgf.search_files_generator(dataset_id=batch,
+                fields=['dataset_id', 'title', 'checksum'], search_url=search_url,
+                latest=None, replica=None, quiet=True, limit=1000), 1000):
+            matches = classify(session, [(d['title'], d['checksum'][0]) for d in docs])
+            for d, (exact, partial) in zip(docs, matches):
+                c = counts.setdefault(d['dataset_id'], [0, 0])
+                c[0] += exact
+                c[1] += 1
+
+    local = {}
+    for dataset_id, (matched, total) in counts.items():
+        if matched == 0:
+            continue
+        m, v = ids[dataset_id]
+        if m not in local or version_key(local[m][0]) < version_key(v):
+            local[m] = (v, matched, total)
+    return local
+
+def version_report(session, dataset_ids, search_url=None):
+    """
+    Compare the local and latest versions of the datasets `dataset_ids`
+
+    Returns a list of dicts with the master_id, latest version, local
+    version (None if no version is held), and the number of files of the
+    local version that are held and in total
+    """
+    masters = sorted(set(master_id(i) for i in dataset_ids))
+    versions, latest = dataset_versions(masters, search_url)
+    local = local_versions(session, versions, search_url)
+
+    report = []
+    for m in masters:
+        v, matched, total = local.get(m, (None, 0, 0))
+        report.append({
+            'master_id': m,
+            'latest': latest.get(m),
+            'local': v,
+            'local_files': matched,
+            'files': total,
+            })
+    return report
+
+def print_versions(report):
+    print("\nlocal\t\tlatest\t\tfiles\tdataset")
+    for r in report:
+        if r['local'] is None:
+            status = 'none'
+        else:
+            status = '%d/%d'%(r['local_files'], r['files'])
+        print("%s\t%s\t%s\t%s%s"%(r['local'] or '-\t', r['latest'] or '-\t', status,
+            r['master_id'], '' if r['local'] in (None, r['latest']) else ' (outdated)'))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest import throttle
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.model import Base, Checksum, Basename
+
+@pytest.fixture
+def esgf_server():
+    """
+    Fake ESGF search server with 4 datasets of 5 files each
+    """
+    with FakeESGF(datasets=4, files=5, max_limit=3) as server:
+        throttle.configure(server.search_url, rate=1e9, burst=1e9)
+        yield server
+
+@pytest.fixture
+def local_session(esgf_server):
+    """
+    SQLite checksum database holding the first dataset of `esgf_server`,
+    and an old version of the second dataset
+    """
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    s = sessionmaker(bind=engine)()
+
+    first = esgf_server.datasets[0]['id']
+    second = esgf_server.datasets[1]['id']
+    for i, f in enumerate(esgf_server.files):
+        if f['dataset_id'] == first:
+            s.add(Checksum(id='c%d'%i, md5=None, sha256=f['checksum'][0]))
+            s.add(Basename(id='b%d'%i, basename=f['title']))
+        if f['dataset_id'] == second:
+            s.add(Basename(id='b%d'%i, basename=f['title']))
+    s.commit()
+    return s
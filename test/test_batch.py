@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import json
+from esgfrequest.batch import load_queries, parse_query, run_batch, write_results
+from esgfrequest.cli import search_esgf
+
+def test_parse_query():
+    args = parse_query({'model': ['A', '^B'], 'variable': 'tas', 'latest': 'all'})
+    assert args['model'] == [['A']]
+    assert args['model!'] == ['B']
+    assert args['variable'] == [['tas']]
+    assert args['latest'] is None
+    assert args['replica'] == False
+
+def test_run_batch(esgf_server, local_session, tmp_path):
+    path = tmp_path / 'queries.jsonl'
+    with open(str(path), 'w') as f:
+        for q in [
+                {'name': 'tas', 'variable': 'tas'},
+                {},
+                {'name': 'tas-again', 'variable': ['tas']},
+                ]:
+            q['search_url'] = esgf_server.search_url
+            f.write(json.dumps(q) + '\n')
+    queries = load_queries(str(path))
+    assert [n for n, a in queries] == ['tas', 'query0002', 'tas-again']
+
+    out = run_batch(queries, local_session)
+
+    expected, count = search_esgf({'search_url': esgf_server.search_url},
+            1000, local_session)
+    assert out[1][1] == expected
+    assert out[1][2] == count == 20
+
+    assert out[0][1] == out[2][1]
+    assert out[0][2] == 10
+    assert all(v['variable'] == 'tas' for v in out[0][1].values())
+
+    write_results(str(tmp_path / 'tas.json'), *out[0])
+    with open(str(tmp_path / 'tas.json')) as f:
+        assert json.load(f)['count'] == 10
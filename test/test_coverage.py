@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+from esgfrequest.cli import search_esgf
+from esgfrequest.coverage import CoverageStore, refresh
+from esgfrequest.db import add_files
+from esgfrequest.server import QueryService
+
+def test_refresh(esgf_server, local_session, tmp_path):
+    store = CoverageStore(str(tmp_path / 'coverage.db'))
+    args = {'search_url': esgf_server.search_url}
+
+    assert refresh(store, args, local_session) == 20
+    expected, count = search_esgf(args, 1000, local_session)
+    ids = [d['id'] for d in esgf_server.datasets]
+    rows = store.get(ids)
+    assert len(rows) == 4
+    for r in rows:
+        e = expected[r['dataset_id'] + ' ' + r['variable']]
+        assert [r[c] for c in ['matches', 'partial', 'misses', 'size']] == [
+                e[c] for c in ['matches', 'partial', 'misses', 'size']]
+
+    # The complete first dataset isn't checked again
+    second = [f for f in esgf_server.files if f['dataset_id'] == ids[1]]
+    add_files(local_session, [(f['title'], None, f['checksum'][0]) for f in second])
+    local_session.commit()
+    assert refresh(store, args, local_session) == 15
+    [row] = store.get([ids[1]])
+    assert (row['matches'], row['partial']) == (5, 0)
+
+    assert refresh(store, args, local_session) == 10
+
+    # Served by the query service
+    service = QueryService(None, coverage=store)
+    assert service.lookup_coverage([ids[1]])['results'] == [row]
+
+    assert refresh(store, args, local_session, full=True) == 20
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import threading
+import os
+import sqlite3
+import pytest
+from sqlalchemy.orm import sessionmaker, scoped_session
+from esgfrequest.db import connect, mirror
+from esgfrequest.model import Checksum, Basename
+from esgfrequest.match import classify_parallel
+from esgfrequest.cli import check_local_db
+
+def test_connect_pool(tmp_path):
+    session = scoped_session(sessionmaker())
+    engine = connect('sqlite:///%s'%(tmp_path / 'mas.db'), init=True,
+            session=session, pool_size=2, max_overflow=1, pool_recycle=60)
+
+    assert engine.pool.size() == 2
+    assert session().get_bind() is engine
+
+    # Each thread gets its own session
+    others = []
+    t = threading.Thread(target=lambda: others.append(session()))
+    t.start()
+    t.join()
+    assert others[0] is not session()
+
+def test_classify_parallel(tmp_path):
+    session = scoped_session(sessionmaker())
+    connect('sqlite:///%s'%(tmp_path / 'mas.db'), init=True, session=session)
+    s = session()
+    s.add_all([
+        Checksum(id='1', md5='aaa', sha256='AAA'),
+        Basename(id='1', basename='a.nc'),
+        Basename(id='2', basename='old.nc'),
+        ])
+    s.commit()
+
+    files = [('a.nc', 'aaa'), ('old.nc', 'ccc'), ('new.nc', 'ddd')] * 5
+    r = list(classify_parallel(session, files, batch_size=2, workers=3))
+    assert r == [(1, 0), (0, 1), (0, 0)] * 5
+
+def test_mirror(tmp_path):
+    session = scoped_session(sessionmaker())
+    source = connect('sqlite:///%s'%(tmp_path / 'mas.db'), init=True, session=session)
+    s = session()
+    s.add_all([
+        Checksum(id='1', md5='aaa', sha256='AAA'),
+        Basename(id='1', basename='a.nc'),
+        Basename(id='2', basename='old.nc'),
+        ])
+    s.commit()
+
+    path = str(tmp_path / 'mirror.db')
+    assert mirror(source, path, batch_size=1) == 3
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    indexes = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert 'ix_checksums_md5' in indexes
+    assert 'ix_basenames_basename' in indexes
+    conn.close()
+
+    local = scoped_session(sessionmaker())
+    connect('sqlite:///%s'%path, session=local)
+    r = list(classify_parallel(local, [('a.nc', 'aaa'), ('old.nc', 'ccc')]))
+    assert r == [(1, 0), (0, 1)]
+
+    # Mirroring again in the same process works, and creating the MAS
+    # tables doesn't create the indexes
+    assert mirror(source, path) == 3
+    connect('sqlite:///%s'%(tmp_path / 'other.db'), init=True,
+            session=scoped_session(sessionmaker()))
+    conn = sqlite3.connect(str(tmp_path / 'other.db'))
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'ix_%'").fetchall() == []
+    conn.close()
+
+def test_check_local_db(tmp_path):
+    path = str(tmp_path / 'missing.db')
+    with pytest.raises(IOError):
+        check_local_db(path)
+    # No empty database is left behind
+    assert not os.path.exists(path)
+
+    sqlite3.connect(path).close()
+    with pytest.raises(IOError):
+        check_local_db(path)
+
+    connect('sqlite:///%s'%path, init=True, session=scoped_session(sessionmaker()))
+    check_local_db(path)
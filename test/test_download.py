@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import hashlib
+import os
+import threading
+import pytest
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest.download import download, HostLimiter, cli
+from esgfrequest.verify import DigestCache
+from esgfrequest.db import add_files
+from esgfrequest.match import classify
+from esgfrequest.model import Base
+
+files = {
+        '/a.nc': b'a' * 3000000,
+        '/b.nc': b'b' * 1000,
+        '/bad.nc': b'not b',
+        }
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.ranges.append((self.path, self.headers.get('Range')))
+        body = files[self.path]
+        r = self.headers.get('Range')
+        if r is not None:
+            start = int(r.split('=')[1].rstrip('-'))
+            body = body[start:]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def file_server():
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.ranges = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def request(server, path, real=None, checksum_type='SHA256', fallbacks=()):
+    url = 'http://127.0.0.1:%d%s'%(server.server_address[1], path)
+    h = hashlib.new(checksum_type.lower(), files[real or path]).hexdigest()
+    fields = [path[1:], url, checksum_type, h]
+    fields += ['http://127.0.0.1:%d%s'%(server.server_address[1], f) for f in fallbacks]
+    return (fields, ' '.join(fields) + '\n')
+
+def test_download(file_server, tmp_path):
+    lines = [request(file_server, '/a.nc'), request(file_server, '/b.nc', checksum_type='MD5')]
+
+    # Half of a.nc is already downloaded
+    with open(str(tmp_path / 'a.nc.part'), 'wb') as f:
+        f.write(files['/a.nc'][:1000000])
+
+    results = list(download(lines, str(tmp_path), workers=2))
+    assert [e for f, e in results] == [None, None]
+
+    for name in ['a.nc', 'b.nc']:
+        with open(str(tmp_path / name), 'rb') as f:
+            assert f.read() == files['/' + name]
+    assert not os.path.exists(str(tmp_path / 'a.nc.part'))
+    assert ('/a.nc', 'bytes=1000000-') in file_server.ranges
+
+def test_checksum_fallback(file_server, tmp_path):
+    # The first URL serves the wrong data
+    line = request(file_server, '/bad.nc', real='/b.nc', fallbacks=['/b.nc'])
+    [(fields, error)] = download([line], str(tmp_path))
+    assert error is None
+    with open(str(tmp_path / 'bad.nc'), 'rb') as f:
+        assert f.read() == files['/b.nc']
+
+    # No good copy
+    line = request(file_server, '/b.nc', real='/a.nc')
+    [(fields, error)] = download([line], str(tmp_path / 'x'))
+    assert 'mismatch' in str(error)
+
+def size_mtime(path):
+    st = os.stat(str(path))
+    return (st.st_size, st.st_mtime)
+
+def test_existing(file_server, tmp_path):
+    cache = DigestCache(str(tmp_path / 'digests.db'))
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    # Already downloaded
+    with open(str(dest / 'b.nc'), 'wb') as f:
+        f.write(files['/b.nc'])
+    [(fields, error)] = download([request(file_server, '/b.nc')], str(dest), cache=cache)
+    assert error is None
+    assert file_server.ranges == []
+    assert len(cache.get([(str(dest / 'b.nc'), 'sha256') + size_mtime(dest / 'b.nc')])) == 1
+
+    # Another version with the same name is left alone
+    line = request(file_server, '/b.nc', real='/a.nc')
+    [(fields, error)] = download([line], str(dest), cache=cache)
+    assert 'different' in str(error)
+    assert file_server.ranges == []
+    with open(str(dest / 'b.nc'), 'rb') as f:
+        assert f.read() == files['/b.nc']
+
+def test_unsafe_title(file_server, tmp_path):
+    for title in ['../b.nc', '/tmp/b.nc', '..']:
+        fields, line = request(file_server, '/b.nc')
+        fields[0] = title
+        [(fields, error)] = download([(fields, line)], str(tmp_path / 'dest'))
+        assert isinstance(error, ValueError)
+    assert file_server.ranges == []
+    assert not os.path.exists(str(tmp_path / 'b.nc'))
+
+def test_host_limit():
+    limiter = HostLimiter(per_host=1)
+    s = limiter('http://a.example.org/x.nc')
+    assert s is limiter('http://a.example.org/y.nc')
+    assert s is not limiter('http://b.example.org/x.nc')
+    assert s.acquire(False)
+    assert not s.acquire(False)
+
+def test_record(file_server, tmp_path):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    s = sessionmaker(bind=engine)()
+
+    fields, line = request(file_server, '/b.nc')
+    assert classify(s, [(fields[0], fields[3])]) == [(0, 0)]
+    add_files(s, [(fields[0], None, fields[3])])
+    s.commit()
+    assert classify(s, [(fields[0], fields[3])]) == [(1, 0)]
+
+def test_cli_record(file_server, tmp_path, monkeypatch):
+    from esgfrequest.db import Session
+    from esgfrequest.model import Checksum
+
+    path = tmp_path / 'request.txt'
+    with open(str(path), 'w') as f:
+        for fields, line in [request(file_server, '/a.nc'), request(file_server, '/b.nc')]:
+            f.write(line)
+
+    db = str(tmp_path / 'local.db')
+    monkeypatch.setattr('sys.argv', ['esgfrequest-download', str(path),
+        '--dest', str(tmp_path / 'dest'), '--db', db,
+        '--index', str(tmp_path / 'index.db'), '--cache', str(tmp_path / 'cache.db')])
+
+    # Running again only checks the files, without recording them again
+    for run in range(2):
+        assert cli() == 0
+        Session.remove()
+        assert Session().query(Checksum).count() == 2
+        Session.remove()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import threading
+import pytest
+from esgfrequest import esgf
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.flight import SingleFlight
+
+def test_coalesce():
+    with FakeESGF(datasets=4, files=5, latency=0.3) as server:
+        before = dict(esgf.single_flight.stats)
+        results = []
+        def search(**kwargs):
+            results.append(esgf.search_raw(search_url=server.search_url, **kwargs))
+
+        threads = [threading.Thread(target=search) for i in range(5)]
+        threads.append(threading.Thread(target=search, kwargs={'limit': 20}))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # One request for the 5 identical searches, and one for the other
+        assert server.requests == 2
+        assert esgf.single_flight.stats['coalesced'] - before['coalesced'] == 4
+        assert len(results) == 6
+
+        # Finished searches aren't reused
+        esgf.search_raw(search_url=server.search_url)
+        assert server.requests == 3
+
+def test_error():
+    flight = SingleFlight()
+    def fail():
+        raise ValueError("failed")
+    with pytest.raises(ValueError):
+        flight.do('a', fail)
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.stats == {'calls': 2, 'coalesced': 0}
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest.model import Base, Checksum, Basename
+from esgfrequest.match import classify, classify_all, classify_stream, chunks, _CopyReader, \
+        _load_candidates
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    s = sessionmaker(bind=engine)()
+    s.add_all([
+        Checksum(id='1', md5='aaa', sha256='AAA'),
+        Checksum(id='2', md5='bbb', sha256='BBB'),
+        Basename(id='1', basename='a.nc'),
+        Basename(id='2', basename='b.nc'),
+        Basename(id='3', basename='old.nc'),
+        ])
+    s.commit()
+    return s
+
+def test_chunks():
+    assert list(chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunks([], 2)) == []
+
+def test_classify(session):
+    r = classify(session, [
+        ('a.nc', 'aaa'),    # md5 match
+        ('b.nc', 'BBB'),    # sha256 match
+        ('old.nc', 'ccc'),  # filename only
+        ('new.nc', 'ddd'),  # nothing
+        ('x.nc', 'aaa'),    # checksum under a different name
+        ])
+    assert r == [(1, 0), (1, 0), (0, 1), (0, 0), (1, 0)]
+
+def test_classify_empty(session):
+    assert classify(session, []) == []
+
+def test_classify_all(session):
+    files = [('a.nc', 'aaa'), ('old.nc', 'ccc'), ('new.nc', 'ddd')] * 3
+    r = list(classify_all(session, files, batch_size=2))
+    assert r == [(1, 0), (0, 1), (0, 0)] * 3
+
+def test_classify_stream(session):
+    files = [('a.nc', 'aaa'), ('old.nc', 'ccc'), ('new.nc', 'ddd'), ('b.nc', 'BBB')]
+    r = list(classify_stream(session, iter(files * 3), batch_size=5))
+    assert r == [
+        ('a.nc', 'aaa', 1, 0),
+        ('old.nc', 'ccc', 0, 1),
+        ('new.nc', 'ddd', 0, 0),
+        ('b.nc', 'BBB', 1, 0),
+        ] * 3
+
+    # Temporary table is cleaned up
+    assert list(classify_stream(session, [])) == []
+
+def test_copy_reader():
+    reader = _CopyReader([('a.nc', 'aaa'), ('tab\there.nc', None)])
+    out = ''
+    while True:
+        chunk = reader.read(5)
+        if chunk == '':
+            break
+        out += chunk
+    assert out == '0\ta.nc\taaa\n1\ttab\\there.nc\t\\N\n'
+
+class FakeCursor(object):
+    def __init__(self):
+        self.copied = None
+        self.executed = []
+
+    def copy_expert(self, sql, f):
+        self.executed.append(sql)
+        self.copied = ''
+        while True:
+            chunk = f.read(7)
+            if chunk == '':
+                break
+            self.copied += chunk
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+class FakePostgres(object):
+    """
+    Records the statements run on a Postgres connection
+    """
+    class dialect(object):
+        name = 'postgresql'
+
+    def __init__(self):
+        self.executed = []
+        self.copy_cursor = FakeCursor()
+        # Stands in for the DBAPI connection too
+        self.connection = self
+
+    def cursor(self):
+        return self.copy_cursor
+
+    def execute(self, statement):
+        self.executed.append(str(statement))
+
+def test_load_candidates_postgres():
+    conn = FakePostgres()
+    table = _load_candidates(conn, iter([('a.nc', 'aaa'), ('b.nc', None)]), 10)
+
+    assert table == 'pg_temp.esgfrequest_candidates'
+    assert conn.executed[0] == 'DROP TABLE IF EXISTS pg_temp.esgfrequest_candidates'
+    assert conn.executed[1].startswith('CREATE TEMPORARY TABLE esgfrequest_candidates ')
+    assert conn.copy_cursor.executed == [
+            'COPY pg_temp.esgfrequest_candidates (idx, basename, checksum) FROM STDIN',
+            'ANALYZE pg_temp.esgfrequest_candidates',
+            ]
+    assert conn.copy_cursor.copied == '0\ta.nc\taaa\n1\tb.nc\t\\N\n'
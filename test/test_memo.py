@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+from esgfrequest.cli import search_esgf
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.memo import SearchMemo, DatasetIndex
+
+def test_memo_search(esgf_server, local_session):
+    memo = SearchMemo()
+    url = esgf_server.search_url
+
+    def search(**args):
+        args['search_url'] = url
+        return search_esgf(args, 1000, local_session, memo=memo)
+
+    # Page size is 3, so 4 datasets take 2 requests and 10 files take 4
+    tas, count = search(variable=[['tas']])
+    assert count == 10
+    assert esgf_server.requests == 1 + 4
+
+    # Only pr is searched for
+    both, count = search(variable=[['tas', 'pr']])
+    assert count == 20
+    assert esgf_server.requests == 5 + 2 + (4 + 1)
+
+    # Nothing new
+    again, count = search(variable=[['tas']])
+    assert again == tas
+    assert esgf_server.requests == 12 + 1
+
+    assert memo.stats['file_searches'] == 3
+    assert memo.stats['file_searches_avoided'] == 1
+    assert memo.stats['datasets_reused'] == 2
+    assert memo.stats['files_reused'] == 20
+
+    # Same results as without the memo
+    plain, count = search_esgf({'search_url': url, 'variable': [['tas', 'pr']]},
+            1000, local_session)
+    assert plain == both
+
+def test_memo_all_variables(esgf_server, local_session):
+    memo = SearchMemo()
+    url = esgf_server.search_url
+
+    everything, count = search_esgf({'search_url': url}, 1000, local_session, memo=memo)
+    assert count == 20
+    requests = esgf_server.requests
+
+    # Filtered from the complete file lists
+    tas, count = search_esgf({'search_url': url, 'variable': [['tas']]},
+            1000, local_session, memo=memo)
+    assert count == 10
+    assert esgf_server.requests == requests + 1
+
+def test_memo_multiple_variables(esgf_server, local_session):
+    # Files holding both variables are only counted once
+    for f in esgf_server.files:
+        f['variable'] = ['tas', 'pr']
+
+    args = {'search_url': esgf_server.search_url, 'variable': [['tas', 'pr']]}
+    plain, count = search_esgf(dict(args), 1000, local_session)
+    assert count == 20
+    memoised, count = search_esgf(dict(args), 1000, local_session, memo=SearchMemo())
+    assert count == 20
+    assert memoised == plain
+
+def test_dataset_index(esgf_server, local_session, tmp_path):
+    url = esgf_server.search_url
+    path = str(tmp_path / 'datasets.db')
+
+    def search(**args):
+        # A new memo each time, as in separate runs
+        memo = SearchMemo(index=DatasetIndex(path))
+        args['search_url'] = url
+        results = search_esgf(args, 1000, local_session, memo=memo)
+        return results, memo
+
+    (tas, count), memo = search(variable=[['tas']])
+    assert count == 10
+    assert memo.stats['file_searches'] == 1
+    requests = esgf_server.requests
+
+    # Only the dataset search is repeated
+    (again, count), memo = search(variable=[['tas']])
+    assert again == tas
+    assert memo.stats['file_searches'] == 0
+    assert memo.stats['datasets_indexed'] == 2
+    assert esgf_server.requests == requests + 1
+
+    # All variables are a different file list
+    (everything, count), memo = search()
+    assert count == 20
+    assert memo.stats['file_searches'] == 1
+    (everything_again, count), memo = search(variable=[['pr']])
+    assert count == 10
+    assert memo.stats['file_searches'] == 0
+
+class TruncatedESGF(FakeESGF):
+    """
+    Index node returning an empty page part way through file searches
+    """
+    def search(self, params):
+        result = super(TruncatedESGF, self).search(params)
+        if params.get('type') == ['File'] and int(params.get('offset', [0])[0]) >= 3:
+            result['response']['docs'] = []
+        return result
+
+def test_dataset_index_incomplete(local_session, tmp_path):
+    index = DatasetIndex(str(tmp_path / 'datasets.db'))
+    with TruncatedESGF(datasets=4, files=5, max_limit=3) as server:
+        memo = SearchMemo(index=index)
+        results, count = search_esgf({'search_url': server.search_url}, 1000,
+                local_session, memo=memo)
+        assert count == 3
+    keys = [(d['id'], None) for d in server.datasets]
+    assert index.get(keys) == {}
+
+def test_versioned(tmp_path):
+    index = DatasetIndex(str(tmp_path / 'datasets.db'))
+    index.add([
+        (('cmip5.a.v20120101|node', None), [{'title': 'a.nc', 'variable': ['tas']}]),
+        (('cmip5.b|node', None), [{'title': 'b.nc', 'variable': ['tas']}]),
+        ])
+    assert index.get([('cmip5.a.v20120101|node', 'tas'), ('cmip5.a.v20120101|node', 'pr'),
+        ('cmip5.b|node', None)]) == {
+            ('cmip5.a.v20120101|node', 'tas'): [{'title': 'a.nc', 'variable': ['tas']}],
+            ('cmip5.a.v20120101|node', 'pr'): [],
+            }
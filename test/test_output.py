@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import csv
+import json
+import pytest
+from esgfrequest.cli import search_esgf, cli
+from esgfrequest.memo import SearchMemo
+from esgfrequest.output import open_writer, columns
+
+class RecordingWriter(object):
+    """
+    Records the number of server requests made when each row is written
+    """
+    def __init__(self, server):
+        self.server = server
+        self.rows = []
+        self.closed = False
+
+    def write(self, row):
+        self.rows.append((self.server.requests, row))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize('memo', [None, SearchMemo()])
+@pytest.mark.parametrize('processes', [None, 2])
+def test_streaming(esgf_server, local_session, memo, processes):
+    writer = RecordingWriter(esgf_server)
+    # One dataset per page
+    args = {'search_url': esgf_server.search_url, 'limit': 1}
+    results, count = search_esgf(args, 1000, local_session, batch_size=3,
+            memo=memo, writer=writer, processes=processes)
+
+    assert writer.closed
+    assert sorted(r['key'] for n, r in writer.rows) == sorted(results)
+    for n, row in writer.rows:
+        assert row == dict(results[row['key']], key=row['key'])
+
+    # Rows were written while the search was still running
+    assert writer.rows[0][0] < writer.rows[-1][0]
+
+def test_limit(esgf_server, local_session):
+    writer = RecordingWriter(esgf_server)
+    results, count = search_esgf({'search_url': esgf_server.search_url}, 7,
+            local_session, writer=writer)
+    assert count == 7
+    assert sorted(r['key'] for n, r in writer.rows) == sorted(results)
+
+def test_formats(esgf_server, local_session, tmp_path):
+    args = {'search_url': esgf_server.search_url}
+
+    path = str(tmp_path / 'out.jsonl')
+    results, count = search_esgf(args, 1000, local_session, writer=open_writer('jsonl', path))
+    with open(path) as f:
+        rows = [json.loads(l) for l in f]
+    assert sorted(r['key'] for r in rows) == sorted(results)
+
+    path = str(tmp_path / 'out.csv')
+    search_esgf(args, 1000, local_session, writer=open_writer('csv', path))
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0].keys()) == columns
+    assert len(rows) == len(results)
+
+def test_parquet(esgf_server, local_session, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'out.parquet')
+    results, count = search_esgf({'search_url': esgf_server.search_url}, 1000,
+            local_session, writer=open_writer('parquet', path))
+    table = pq.read_table(path)
+    assert table.num_rows == len(results)
+    assert sum(table.column('size').to_pylist()) == 20 * 1000000
+
+def test_parquet_arguments(monkeypatch, capsys):
+    def connect_db(*args, **kwargs):
+        raise AssertionError("Connected to the database")
+    monkeypatch.setattr('esgfrequest.cli.connect_db', connect_db)
+    monkeypatch.setenv('USER', 'test')
+
+    monkeypatch.setattr('sys.argv', ['esgfrequest', '--format', 'parquet'])
+    with pytest.raises(SystemExit):
+        cli()
+    assert '--output' in capsys.readouterr().err
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import pytest
+from sqlalchemy.orm import sessionmaker, scoped_session
+from esgfrequest.cli import search_esgf, aggregate
+from esgfrequest.db import connect
+from esgfrequest.model import Checksum, Basename
+from esgfrequest.parallel import aggregate_processes, engine_url, partition
+
+@pytest.fixture
+def file_session(esgf_server, tmp_path):
+    """
+    Checksum database in a file, so worker processes can see it
+    """
+    session = scoped_session(sessionmaker())
+    connect('sqlite:///%s'%(tmp_path / 'mas.db'), init=True, session=session)
+    s = session()
+    for i, f in enumerate(esgf_server.files[::3]):
+        s.add(Checksum(id=str(i), md5=None, sha256=f['checksum'][0]))
+    for i, f in enumerate(esgf_server.files[1::3]):
+        s.add(Basename(id=str(i), basename=f['title']))
+    s.commit()
+    return s
+
+def test_partition():
+    assert partition('a.b.c|node', 4) == partition('a.b.c|node', 4)
+    assert 0 <= partition('a.b.c|node', 4) < 4
+
+def test_aggregate_processes(esgf_server, file_session):
+    docs = list(esgf_server.files)
+
+    serial = {}
+    count = aggregate(docs, file_session, serial)
+
+    parallel = {}
+    pcount = aggregate_processes(iter(docs), engine_url(file_session), parallel,
+            processes=3, batch_size=4, chunk_size=2)
+
+    assert pcount == count == 20
+    assert list(parallel.items()) == list(serial.items())
+
+def test_search_esgf_processes(esgf_server, file_session):
+    args = {'search_url': esgf_server.search_url}
+    serial, count = search_esgf(args, 1000, file_session)
+    parallel, pcount = search_esgf(args, 1000, file_session, processes=2)
+    assert pcount == count
+    assert list(parallel.items()) == list(serial.items())
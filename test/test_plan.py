@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest.cli import search_esgf
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.model import Base, Checksum
+from esgfrequest.plan import TransferPlanner, TransferPlan
+
+@pytest.fixture
+def two_node_server():
+    with FakeESGF(datasets=4, files=5, max_limit=3,
+            data_nodes=['a.example.org', 'b.example.org'], size=10000000) as server:
+        yield server
+
+def test_planner(two_node_server):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    s = sessionmaker(bind=engine)()
+    # One file of a.example.org is local
+    s.add(Checksum(id='c0', md5=None, sha256=two_node_server.files[0]['checksum'][0]))
+    s.commit()
+
+    planner = TransferPlanner()
+    search_esgf({'search_url': two_node_server.search_url}, 1000, s,
+            batch_size=3, planner=planner)
+
+    assert planner.nodes['a.example.org']['files'] == 9
+    assert planner.nodes['a.example.org']['bytes'] == 90000000
+    assert planner.nodes['b.example.org']['files'] == 10
+
+    plan = planner.plan({'a.example.org': 12e6, 'b.example.org': 1e6})
+    nodes = {n['node']: n for n in plan.nodes}
+
+    # 12 MB/s needs 3 connections at the default 5 MB/s each
+    assert nodes['a.example.org']['connections'] == 3
+    assert nodes['a.example.org']['bandwidth'] == 12e6
+    assert nodes['b.example.org']['connections'] == 1
+    assert nodes['b.example.org']['seconds'] == pytest.approx(100)
+
+    # Nodes are downloaded from in parallel
+    assert plan.seconds == pytest.approx(100)
+    assert plan.fits(3600)
+    assert not plan.fits(60)
+
+def test_link_limit():
+    plan = TransferPlan([
+        {'node': 'a', 'bytes': 100e6, 'seconds': 10},
+        {'node': 'b', 'bytes': 100e6, 'seconds': 10},
+        ], link=10e6)
+    assert plan.seconds == pytest.approx(20)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import threading
+import pytest
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from esgfrequest import cli
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.replicas import NodeRanking, find_replicas, data_node
+
+@pytest.fixture
+def replica_server():
+    with FakeESGF(datasets=2, files=3, data_nodes=['orig.example.org'],
+            replica_nodes=['fast.example.org', 'slow.example.org']) as server:
+        yield server
+
+def test_find_replicas(replica_server):
+    originals = [f for f in replica_server.files if not f['replica']]
+    urls = find_replicas(originals, replica_server.search_url, batch_size=4)
+    assert len(urls) == 6
+    for f in originals:
+        assert sorted(data_node(u) for u in urls[f['instance_id']]) == [
+                'fast.example.org', 'orig.example.org', 'slow.example.org']
+
+def test_render_request_replicas(replica_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'requestdir', str(tmp_path))
+    monkeypatch.setenv('USER', 'test')
+
+    ranking = NodeRanking({'fast.example.org': 100e6, 'slow.example.org': 1e6})
+    d = replica_server.datasets[0]
+    path = cli.render_request([(d['id'], d['variable'][0])], 'request',
+            search_url=replica_server.search_url, ranking=ranking, fallbacks=1)
+
+    with open(path) as f:
+        lines = f.readlines()
+    assert len(lines) == 3
+    fields = lines[0].split()
+    assert len(fields) == 5
+    assert 'fast.example.org' in fields[1]
+    assert 'slow.example.org' in fields[4]
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'x' * 1000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_measure():
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+
+    up = 'http://127.0.0.1:%d/a.nc'%server.server_address[1]
+    down = 'http://localhost:1/b.nc'
+
+    ranking = NodeRanking(measure=True)
+    assert ranking.rank([down, up]) == [up, down]
+    assert ranking.speeds['127.0.0.1'] > 0
+    assert ranking.speeds['localhost'] == 0
+
+    thread.join()
+    server.server_close()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import os
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from esgfrequest import cli
+from esgfrequest.pending import RequestIndex, read_request, merge
+
+@pytest.fixture
+def requestdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'requestdir', str(tmp_path))
+    monkeypatch.setenv('USER', 'test')
+    return tmp_path
+
+def test_render_request(esgf_server, requestdir):
+    to_download = [(d['id'], d['variable'][0]) for d in esgf_server.datasets]
+    to_download.reverse()
+
+    path = cli.render_request(to_download, 'request',
+            search_url=esgf_server.search_url, workers=3)
+    assert path.startswith(str(requestdir))
+
+    with open(path) as f:
+        lines = f.readlines()
+
+    # Files are in the order requested
+    expected = [cli.request_line(d) for val in to_download
+            for d in esgf_server.files if d['dataset_id'] == val[0]]
+    assert lines == expected
+    assert lines[0].startswith("'pr_Amon_MODEL3_historical_r1i1p1_0000.nc' 'http://esgf.example.org/")
+
+def test_ordered_map():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(i):
+        with lock:
+            running.append(i)
+            peak.append(len(running))
+        time.sleep(0.01 * (i % 3))
+        with lock:
+            running.remove(i)
+        return i * 2
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        out = list(cli.ordered_map(pool, work, range(20), 4))
+
+    assert out == [i * 2 for i in range(20)]
+    assert max(peak) <= 4
+
+def test_render_request_pending(esgf_server, requestdir):
+    index = RequestIndex(str(requestdir / 'index.db'))
+    d0, d1 = [(d['id'], d['variable'][0]) for d in esgf_server.datasets[:2]]
+
+    first = cli.render_request([d0], 'request', search_url=esgf_server.search_url,
+            index=index)
+    # Only the new dataset's files are written
+    second = cli.render_request([d0, d1], 'update', search_url=esgf_server.search_url,
+            index=index)
+    assert len(read_request(first)) == 5
+    assert len(read_request(second)) == 5
+    assert set(f[3] for f, l in read_request(first)).isdisjoint(
+            f[3] for f, l in read_request(second))
+
+    # Nothing new
+    assert cli.render_request([d1], 'again', search_url=esgf_server.search_url,
+            index=index) is None
+
+    # Requests that have been processed are forgotten
+    os.remove(first)
+    assert index.prune() == 5
+    assert len(index.pending(f['checksum'][0] for f in esgf_server.files)) == 5
+
+def test_merge(requestdir):
+    index = RequestIndex(str(requestdir / 'index.db'))
+    index.add([('c1', 'a.txt', 'one.nc', 10), ('c2', 'a.txt', 'two.nc', 30)])
+
+    a = str(requestdir / 'a.txt')
+    b = str(requestdir / 'b.txt')
+    with open(a, 'w') as f:
+        f.write("'one.nc' 'http://x/one.nc' 'SHA256' 'c1'\n")
+        f.write("'two.nc' 'http://x/two.nc' 'SHA256' 'c2'\n")
+    with open(b, 'w') as f:
+        f.write("'three.nc' 'http://x/three.nc' 'SHA256' 'c3'\n")
+        f.write("'two.nc' 'http://y/two.nc' 'SHA256' 'c2'\n")
+
+    out = str(requestdir / 'merged.txt')
+    assert merge([a, b], out, index) == 3
+    assert [f[0] for f, l in read_request(out)] == ['two.nc', 'one.nc', 'three.nc']
+    assert [f[1] for f, l in read_request(out)][0] == 'http://x/two.nc'
+
+def test_merge_skip_held(requestdir):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from esgfrequest.db import add_files
+    from esgfrequest.model import Base
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    # two.nc has been downloaded
+    add_files(session, [('two.nc', None, 'c2')])
+    session.commit()
+
+    index = RequestIndex(str(requestdir / 'index.db'))
+    index.add([('c1', 'a.txt', 'one.nc', 10), ('c2', 'a.txt', 'two.nc', 30)])
+
+    a = str(requestdir / 'a.txt')
+    with open(a, 'w') as f:
+        f.write("'one.nc' 'http://x/one.nc' 'SHA256' 'c1'\n")
+        f.write("'two.nc' 'http://x/two.nc' 'SHA256' 'c2'\n")
+
+    out = str(requestdir / 'merged.txt')
+    assert merge([a], out, index, session=session) == 1
+    assert [f[0] for f, l in read_request(out)] == ['one.nc']
+    assert index.pending(['c1', 'c2']) == set(['c1'])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import hashlib
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest.match import classify
+from esgfrequest.model import Base
+from esgfrequest.scan import scan, find_files
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+def test_find_files(tmp_path):
+    write(str(tmp_path / 'a' / 'b' / 'x.nc'), b'x')
+    write(str(tmp_path / 'a' / 'y.nc'), b'yy')
+    write(str(tmp_path / 'a' / 'y.txt'), b'y')
+    assert sorted((os.path.basename(p), s) for p, s, m in find_files(str(tmp_path))) == [
+            ('x.nc', 1), ('y.nc', 2)]
+
+def test_scan(tmp_path):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    s = sessionmaker(bind=engine)()
+    root = str(tmp_path / 'data')
+
+    write(os.path.join(root, 'a', 'x.nc'), b'x')
+    write(os.path.join(root, 'b', 'y.nc'), b'y')
+    assert scan(s, root) == {'added': 2, 'removed': 0, 'unchanged': 0}
+    assert classify(s, [('x.nc', sha256(b'x')), ('y.nc', hashlib.md5(b'y').hexdigest()),
+        ('y.nc', 'old'), ('z.nc', 'z')]) == [(1, 0), (1, 0), (0, 1), (0, 0)]
+
+    # Only the changed file is checksummed again
+    write(os.path.join(root, 'a', 'x.nc'), b'new x')
+    assert scan(s, root, types=['sha256']) == {'added': 1, 'removed': 0, 'unchanged': 1}
+    assert classify(s, [('x.nc', sha256(b'x')), ('x.nc', sha256(b'new x'))]) == [
+            (0, 1), (1, 0)]
+
+    os.remove(os.path.join(root, 'b', 'y.nc'))
+    assert scan(s, root) == {'added': 0, 'removed': 1, 'unchanged': 1}
+    assert classify(s, [('y.nc', sha256(b'y'))]) == [(0, 0)]
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+from esgfrequest import esgf
+from esgfrequest.cli import search_esgf
+from esgfrequest.fake_esgf import FakeESGF
+
+class ShortESGF(FakeESGF):
+    """
+    Index node that stops returning docs part way through a search
+    """
+    def search(self, params):
+        result = super(ShortESGF, self).search(params)
+        if int(params.get('offset', [0])[0]) >= 6:
+            result['response']['docs'] = []
+        return result
+
+def test_search_files_generator(esgf_server):
+    docs = list(esgf.search_files_generator(search_url=esgf_server.search_url,
+        fields=['title', 'checksum'], limit=3))
+    assert len(docs) == 20
+    assert sorted(d['title'] for d in docs) == sorted(f['title'] for f in esgf_server.files)
+
+def test_search_generators_short_page():
+    with ShortESGF(datasets=8, files=1, max_limit=3) as server:
+        docs = list(esgf.search_files_generator(search_url=server.search_url, limit=3))
+        assert len(docs) == 6
+
+        docs = list(esgf.search_datasets_generator(search_url=server.search_url, limit=3))
+        assert len(docs) == 6
+
+        docs = list(esgf.search_files_generator(search_url=server.search_url, limit=0))
+        assert docs == []
+
+def test_search_dataset_files_generator(esgf_server):
+    docs = list(esgf.search_dataset_files_generator(search_url=esgf_server.search_url,
+        fields=['dataset_id', 'title'], variable='tas', limit=1))
+    assert len(docs) == 10
+    assert all(d['title'].startswith('tas_') for d in docs)
+
+def test_search_esgf(esgf_server, local_session):
+    args = {'search_url': esgf_server.search_url}
+    results, count = search_esgf(args, 1000, local_session, batch_size=4)
+
+    assert count == 20
+    assert len(results) == 4
+
+    ids = [d['id'] for d in esgf_server.datasets]
+    by_dataset = {v['dataset_id']: v for v in results.values()}
+    assert by_dataset[ids[0]]['matches'] == 5
+    assert by_dataset[ids[1]]['partial'] == 5
+    assert by_dataset[ids[2]]['misses'] == 5
+    assert by_dataset[ids[3]]['size'] == 5 * 1000000
+
+def test_single_stage(esgf_server):
+    done = []
+    docs = list(esgf.search_files_single_stage_generator(search_url=esgf_server.search_url,
+        fields=['title'], variable='tas', on_datasets_done=done.extend))
+    assert len(docs) == 10
+    assert all(d['title'].startswith('tas_') for d in docs)
+
+    # Each dataset is done once all its files have been produced
+    assert done == [esgf_server.datasets[0]['id'], esgf_server.datasets[2]['id']]
+
+    # Facet count then pages of 3 files, no dataset searches
+    assert esgf_server.requests == 1 + 4
+
+def test_single_stage_fallback(esgf_server):
+    # Version is a dataset facet
+    docs = list(esgf.search_files_single_stage_generator(search_url=esgf_server.search_url,
+        fields=['title'], version='20120101'))
+    assert len(docs) == 20
+    assert esgf_server.requests == 2 + 7
+
+    # No facet counts
+    esgf_server.facets = False
+    esgf_server.requests = 0
+    docs = list(esgf.search_files_single_stage_generator(search_url=esgf_server.search_url,
+        fields=['title'], variable='tas'))
+    assert len(docs) == 10
+    assert esgf_server.requests == 1 + 1 + 4
+
+def test_single_stage_negative_fallback():
+    # Negative dataset facet, with the positive facet present but unset
+    with FakeESGF(datasets=2, files=1, versions=2) as server:
+        args = {'search_url': server.search_url, 'fields': ['title'],
+                'version': None, 'version!': '20120101'}
+        docs = list(esgf.search_files_single_stage_generator(**args))
+        two_stage = list(esgf.search_dataset_files_generator(**args))
+        assert len(docs) == len(two_stage) == 2
+
+def test_search_esgf_single_stage(esgf_server, local_session):
+    args = {'search_url': esgf_server.search_url}
+    two_stage, count = search_esgf(args, 1000, local_session)
+    single_stage, count = search_esgf(args, 1000, local_session, single_stage=True)
+    assert single_stage == two_stage
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import json
+import threading
+import pytest
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+from esgfrequest.db import add_files
+from esgfrequest.model import Base
+from esgfrequest.server import QueryService, ResponseCache, make_server
+
+@pytest.fixture
+def service(esgf_server, tmp_path):
+    engine = create_engine('sqlite:///%s'%(tmp_path / 'db.sqlite'))
+    Base.metadata.create_all(engine)
+    session = scoped_session(sessionmaker(bind=engine))
+
+    # The first dataset is held locally
+    first = esgf_server.datasets[0]['id']
+    add_files(session(), [(f['title'], None, f['checksum'][0])
+        for f in esgf_server.files if f['dataset_id'] == first])
+    session.commit()
+    session.remove()
+
+    service = QueryService(session)
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield service, 'http://127.0.0.1:%d'%server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def test_search(esgf_server, service):
+    service, url = service
+
+    r = requests.get(url + '/search', params={'search_url': esgf_server.search_url,
+        'variable': 'tas,pr'})
+    assert r.status_code == 200
+    answer = r.json()
+    assert answer['count'] == 20
+    assert answer['summary']['total_misses'] == 15
+    assert len(answer['results']) == 4
+
+    # The same query again is answered from the cache
+    requests_made = esgf_server.requests
+    r = requests.post(url + '/search', data=json.dumps({
+        'search_url': esgf_server.search_url, 'variable': ['tas', 'pr']}))
+    assert r.json() == answer
+    assert esgf_server.requests == requests_made
+
+    # A different query reuses the memo's file lists
+    r = requests.post(url + '/search', data=json.dumps({
+        'search_url': esgf_server.search_url, 'variable': 'tas', 'limit': 5}))
+    assert r.json()['count'] == 5
+    assert r.json()['limit_reached']
+
+    stats = requests.get(url + '/stats').json()
+    assert stats['service'] == {'queries': 3, 'cached': 1, 'datasets_cached': 8}
+    assert stats['memo']['datasets_reused'] > 0
+
+def test_new_files(esgf_server, service):
+    service, url = service
+    query = {'search_url': esgf_server.search_url, 'variable': 'tas'}
+    assert service.search(query)['summary']['total_misses'] == 5
+
+    # Files recorded after a search are found once its answer expires
+    session = service.session()
+    add_files(session, [(f['title'], None, f['checksum'][0]) for f in esgf_server.files])
+    session.commit()
+    service.session.remove()
+    service.cache.entries.clear()
+
+    requests_made = esgf_server.requests
+    assert service.search(query)['summary']['total_misses'] == 0
+    # Only the dataset search is repeated, file lists are kept
+    assert esgf_server.requests == requests_made + 1
+
+def test_response_cache():
+    cache = ResponseCache(ttl=300, size=2)
+    for i in range(3):
+        cache.add(i, i)
+    assert list(cache.entries) == [1, 2]
+    assert cache.get(0) is None
+    assert cache.get(2) == 2
+
+    cache = ResponseCache(ttl=-1)
+    cache.add(0, 0)
+    cache.add(1, 1)
+    assert list(cache.entries) == []
+
+def test_errors(esgf_server, service):
+    service, url = service
+    r = requests.post(url + '/search', data=json.dumps({'colour': 'blue'}))
+    assert r.status_code == 400
+    assert 'colour' in r.json()['error']
+
+    r = requests.post(url + '/search', data='{')
+    assert r.status_code == 400
+
+    assert requests.get(url + '/other').status_code == 404
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import subprocess
+import sys
+import pytest
+from esgfrequest.cli import strtobool
+
+def importtime(code):
+    """
+    Run `code` in a new interpreter with `-X importtime`
+
+    Returns a dict of module name to cumulative import time in microseconds
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+    modules = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+        reason="-X importtime and the lazy __version__ need Python 3.7")
+def test_cli_startup():
+    baseline = importtime('pass')
+    modules = importtime('import esgfrequest.cli; esgfrequest.cli.logger')
+    imported = set(modules) - set(baseline)
+
+    for heavy in ['requests', 'sqlalchemy', 'sqlite3', 'distutils',
+            'esgfrequest.esgf', 'esgfrequest._version']:
+        assert heavy not in imported
+
+    print("esgfrequest.cli import time: %.1f ms"%(modules['esgfrequest.cli'] / 1000))
+
+def test_version():
+    import esgfrequest
+    assert isinstance(esgfrequest.__version__, str)
+
+def test_strtobool():
+    assert strtobool('Yes') == 1
+    assert strtobool('f') == 0
+    with pytest.raises(ValueError):
+        strtobool('maybe')
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import pytest
+from esgfrequest.table import ResultTable, as_table
+from esgfrequest.cli import print_results
+
+@pytest.fixture
+def results():
+    def row(d, v, matches, partial, misses, size):
+        return ('%s %s'%(d, v), {'dataset_id': d, 'variable': v, 'matches': matches,
+            'partial': partial, 'misses': misses, 'size': size})
+    return dict([
+        row('a', 'tas', 5, 0, 0, 100),
+        row('b', 'tas', 0, 2, 1, 300),
+        row('c', 'pr', 1, 0, 4, 200),
+        ])
+
+def test_round_trip(results):
+    table = ResultTable.from_results(results)
+    assert len(table) == 3
+    assert table.to_results() == results
+    assert as_table(table) is table
+
+def test_summary(results):
+    assert as_table(results).summary() == {
+            'total_misses': 5,
+            'missing_size': 500,
+            'total_partial': 2,
+            'partial_size': 300,
+            }
+    assert as_table({}).summary()['total_misses'] == 0
+
+def test_sort_take(results):
+    table = as_table(results)
+    assert list(table.sort('size', reverse=True).key) == ['b tas', 'c pr', 'a tas']
+    assert list(table.take(table.misses > 0).key) == ['b tas', 'c pr']
+    assert table.downloads('partial') == [('b', 'tas')]
+
+def test_print_results(results, capsys):
+    print_results(results, 10, 1000)
+    out = capsys.readouterr().out
+    assert "Partial matches:    2 files," in out
+    assert "Missing files:      5 files," in out
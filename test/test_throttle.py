@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import json
+import threading
+import time
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from esgfrequest import esgf, throttle
+from esgfrequest.throttle import TokenBucket, AdaptiveLimit
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, burst=2)
+    start = time.time()
+    for i in range(7):
+        bucket.acquire()
+    # 2 from the burst, then 5 at 50/s
+    assert time.time() - start >= 0.09
+
+def test_aimd():
+    limit = AdaptiveLimit(initial=4, minimum=1, maximum=6)
+    for i in range(20):
+        limit.acquire()
+        limit.release(0.1)
+    assert limit.limit == 6
+
+    limit.acquire()
+    limit.release(0.1, throttled=True)
+    assert limit.limit == 3
+
+    # Much slower than the baseline
+    limit.acquire()
+    limit.release(1.0)
+    assert limit.limit == 1.5
+    assert limit.stats == {'requests': 22, 'throttled': 1, 'slow': 1}
+
+def test_request_kinds():
+    limit = AdaptiveLimit(initial=4, maximum=8)
+    # Quick facet counts mixed with slow pages of files
+    for i in range(20):
+        limit.acquire()
+        limit.release(0.01, kind=('File', 0, None))
+        limit.acquire()
+        limit.release(0.5, kind=('File', 10000, None))
+    assert limit.limit == 8
+    assert limit.stats['slow'] == 0
+
+    limit.acquire()
+    limit.release(2.0, kind=('File', 10000, None))
+    assert limit.limit == 4
+    assert limit.stats['slow'] == 1
+
+def test_set_rate(monkeypatch):
+    monkeypatch.setattr(throttle, '_throttles', {})
+    monkeypatch.setattr(throttle, 'default_rate', throttle.default_rate)
+    monkeypatch.setattr(throttle, 'default_burst', throttle.default_burst)
+    throttle.set_rate(5)
+    t = throttle.for_url('http://index.example.org/esg-search/search')
+    assert (t.bucket.rate, t.bucket.burst) == (5, 10)
+
+def test_concurrency():
+    limit = AdaptiveLimit(initial=2)
+    limit.acquire()
+    limit.acquire()
+    waiting = threading.Thread(target=limit.acquire)
+    waiting.start()
+    waiting.join(0.1)
+    assert waiting.is_alive()
+    limit.release(0.1)
+    waiting.join(1)
+    assert not waiting.is_alive()
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.count += 1
+        if self.server.count == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'response': {'numFound': 0, 'docs': []}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_retry():
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    server.count = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = 'http://127.0.0.1:%d/esg-search/search'%server.server_address[1]
+    t = throttle.configure(url, initial=4)
+    r = esgf.search_raw(search_url=url)
+    assert r['response']['numFound'] == 0
+    assert server.count == 2
+    assert t.concurrency.stats['throttled'] == 1
+    assert t.concurrency.limit == 2 + 1.0 / 2
+
+    server.shutdown()
+    server.server_close()
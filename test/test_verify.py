@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+import hashlib
+import os
+from esgfrequest import verify as v
+
+def test_file_digests(tmp_path):
+    data = os.urandom(100000)
+    path = str(tmp_path / 'a.nc')
+    with open(path, 'wb') as f:
+        f.write(data)
+    open(str(tmp_path / 'empty.nc'), 'w').close()
+
+    d = v.file_digests(path, ['md5', 'sha256'])
+    assert d == {'md5': hashlib.md5(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest()}
+    assert v.file_digests(str(tmp_path / 'empty.nc')) == {
+            'sha256': hashlib.sha256(b'').hexdigest()}
+
+def test_verify(tmp_path, monkeypatch):
+    files = []
+    for name, content, checksum_type in [('a.nc', b'a', 'SHA256'), ('b.nc', b'b', 'MD5')]:
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(content)
+        files.append((str(tmp_path / name), checksum_type,
+            hashlib.new(checksum_type.lower(), content).hexdigest().upper()))
+    files.append((str(tmp_path / 'c.nc'), 'SHA256', 'x'))
+
+    cache = v.DigestCache(str(tmp_path / 'cache.db'))
+    assert sorted(v.verify(files, cache=cache)) == [
+            (files[0][0], True), (files[1][0], True), (files[2][0], None)]
+
+    # Unchanged files come from the cache
+    def fail(*args):
+        raise AssertionError("File was read")
+    monkeypatch.setattr(v, 'file_digests', fail)
+    assert sorted(v.verify(files[:2], cache=cache)) == [
+            (files[0][0], True), (files[1][0], True)]
+    monkeypatch.undo()
+
+    # Modified files are read again
+    with open(files[0][0], 'wb') as f:
+        f.write(b'changed')
+    assert sorted(v.verify(files[:2], cache=cache)) == [
+            (files[0][0], False), (files[1][0], True)]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Copyright 2018 ARC Centre of Excellence for Climate Extremes
+# author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from esgfrequest.fake_esgf import FakeESGF
+from esgfrequest.model import Base, Checksum
+from esgfrequest.versions import master_id, version_report, version_key
+
+def test_master_id():
+    assert master_id('cmip5.output1.A.B.v20120101|esgf.example.org') == 'cmip5.output1.A.B'
+    assert master_id('cmip5.output1.A.B') == 'cmip5.output1.A.B'
+
+def test_version_key():
+    assert sorted(['10', '2', 'v1', '20120101'], key=version_key) == ['v1', '2', '10', '20120101']
+    assert version_key('latest') > version_key('20120101')
+
+def test_version_report():
+    with FakeESGF(datasets=3, files=4, versions=3, max_limit=5) as server:
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        s = sessionmaker(bind=engine)()
+
+        # Dataset 0 has 2 files of the second version held, dataset 1 the
+        # whole latest version
+        for f in server.files:
+            if ((f['dataset_id'].startswith(master_id(server.datasets[0]['id']) + '.v2013')
+                    and f['title'].endswith(('0000.nc', '0001.nc'))) or
+                    f['dataset_id'].startswith(master_id(server.datasets[3]['id']) + '.v2014')):
+                s.add(Checksum(id=f['instance_id'], sha256=f['checksum'][0]))
+        s.commit()
+
+        ids = [d['id'] for d in server.datasets if d['latest']]
+        report = version_report(s, ids, server.search_url)
+
+        # 9 dataset versions and their 36 files, in pages of 5
+        assert server.requests == 2 + 8
+
+    assert report == [
+            {'master_id': master_id(ids[0]), 'latest': '20140101', 'local': '20130101',
+                'local_files': 2, 'files': 4},
+            {'master_id': master_id(ids[1]), 'latest': '20140101', 'local': '20140101',
+                'local_files': 4, 'files': 4},
+            {'master_id': master_id(ids[2]), 'latest': '20140101', 'local': None,
+                'local_files': 0, 'files': 0},
+            ]